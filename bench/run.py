@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark gTest's own overhead on synthetic profiles.
+
+Skeletons and gold profiles of the requested size are generated (see
+synthetic.py), and each phase of testing is run in a separate process,
+with the stub mkprof/art/ace in bench/bin, so its wall-clock time and
+peak memory (RSS) can be measured on their own. The `startup` phase
+only imports gTest; its memory is the baseline for the others.
+
+examples:
+  bench/run.py --items 10000 --readings 5
+  bench/run.py -d /tmp/bench --profiles 10 --items 100000 --keep
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+from os.path import (abspath, dirname, join as pjoin, exists)
+
+BENCH_DIR = dirname(abspath(__file__))
+sys.path.insert(0, dirname(BENCH_DIR))  # for gtest
+sys.path.insert(0, BENCH_DIR)  # for synthetic
+
+import synthetic
+
+PHASES = ('startup', 'discovery', 'header', 'parse', 'coverage',
+          'semantics', 'compare')
+# phases that need the parsed profiles of the parse phase
+NEEDS_PARSE = ('coverage', 'semantics', 'compare')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n\n')[1],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__.split('\n\n')[-1]
+    )
+    parser.add_argument('-d', '--data-dir', metavar='DIR',
+                        help='directory for the synthetic data (reused if '
+                             'generated with the same settings; default: a '
+                             'temporary directory)')
+    parser.add_argument('--items', type=int, default=1000, metavar='N',
+                        help='items per profile (default: 1000)')
+    parser.add_argument('--readings', type=int, default=5, metavar='N',
+                        help='readings per grammatical item (default: 5)')
+    parser.add_argument('--profiles', type=int, default=1, metavar='N',
+                        help='number of profiles (default: 1)')
+    parser.add_argument('--differ', type=float, default=0.01, metavar='F',
+                        help='fraction of items whose gold readings differ '
+                             '(default: 0.01)')
+    parser.add_argument('--phases', default=','.join(PHASES),
+                        metavar='LIST',
+                        help='comma-separated phases to run (default: all)')
+    parser.add_argument('--keep', action='store_true',
+                        help='do not remove a temporary data directory')
+    parser.add_argument('--phase', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.phase:
+        run_phase(args.phase, args.data_dir)
+        return
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='gtest-bench-')
+    try:
+        config = {'items': args.items, 'readings': args.readings,
+                  'profiles': args.profiles, 'differ': args.differ}
+        prepare_data(data_dir, config)
+        phases = [p for p in args.phases.split(',') if p]
+        if any(p in NEEDS_PARSE for p in phases) and 'parse' not in phases:
+            phases.insert(0, 'parse')
+        phases.sort(key=PHASES.index)
+        print('{} profile(s) of {} items with {} readings per grammatical '
+              'item'.format(args.profiles, args.items, args.readings))
+        print('{:10s}  {:>9s}  {:>14s}  {:>9s}'.format(
+            'phase', 'wall (s)', 'throughput', 'peak RSS'))
+        for phase in phases:
+            report(phase, *measure(phase, data_dir))
+    finally:
+        if not args.data_dir and not args.keep:
+            shutil.rmtree(data_dir)
+        elif not args.data_dir:
+            print('Data kept in {}'.format(data_dir))
+
+
+def prepare_data(data_dir, config):
+    """
+    Generate the grammar directory, skeletons, and gold profiles under
+    *data_dir*, unless they were generated with the same *config*.
+    """
+    config_path = pjoin(data_dir, 'bench.json')
+    if exists(config_path) and synthetic.load_config(config_path) == config:
+        return
+    for sub in ('grammar', 'work'):
+        if exists(pjoin(data_dir, sub)):
+            shutil.rmtree(pjoin(data_dir, sub))
+    grammar = pjoin(data_dir, 'grammar')
+    os.makedirs(pjoin(grammar, 'ace'))
+    with open(pjoin(grammar, 'ace', 'config.tdl'), 'w') as f:
+        f.write(';; benchmark grammar\n')
+    with open(pjoin(grammar, 'image.dat'), 'w') as f:
+        f.write('benchmark image\n')
+    os.makedirs(pjoin(data_dir, 'work'))
+    for i in range(config['profiles']):
+        name = 'bench{}'.format(i)
+        start = i * config['items'] + 1
+        skel = pjoin(grammar, 'tsdb', 'skeletons', name)
+        gold = pjoin(grammar, 'tsdb', 'gold', name)
+        synthetic.write_skeleton(skel, start, config['items'])
+        shutil.copytree(skel, gold)
+        synthetic.write_parses(gold, config['readings'],
+                               differ=config['differ'])
+    with open(config_path, 'w') as f:
+        json.dump(config, f)
+
+
+def measure(phase, data_dir):
+    """
+    Run *phase* in a new process and return its (wall-clock seconds,
+    count, unit, peak RSS in kilobytes).
+    """
+    env = dict(os.environ)
+    env['PATH'] = pjoin(BENCH_DIR, 'bin') + os.pathsep + env.get('PATH', '')
+    env['GTEST_BENCH_CONFIG'] = pjoin(data_dir, 'bench.json')
+    cmd = [sys.executable, abspath(__file__),
+           '--phase', phase, '--data-dir', data_dir]
+    p = subprocess.Popen(cmd, env=env, stdout=subprocess.PIPE)
+    out = p.stdout.read()
+    maxrss = None
+    if hasattr(os, 'wait4'):
+        _, status, usage = os.wait4(p.pid, 0)
+        p.returncode = 1 if status else 0
+        maxrss = usage.ru_maxrss
+        if sys.platform == 'darwin':
+            maxrss //= 1024
+    else:
+        p.wait()
+    if p.returncode:
+        sys.exit('Phase {} failed.'.format(phase))
+    result = json.loads(out.decode('utf-8').strip().splitlines()[-1])
+    return result['wall'], result['count'], result['unit'], maxrss
+
+
+def report(phase, wall, count, unit, maxrss):
+    throughput = '-'
+    if count and wall > 0:
+        throughput = '{:.0f} {}/s'.format(count / wall, unit)
+    rss = '-' if maxrss is None else '{:.1f} MB'.format(maxrss / 1024.0)
+    print('{:10s}  {:9.3f}  {:>14s}  {:>9s}'.format(
+        phase, wall, throughput, rss))
+
+
+#
+# PHASES (run in their own process)
+#
+
+def run_phase(phase, data_dir):
+    import logging
+    logging.basicConfig(level=logging.ERROR)
+    start = time.time()
+    count, unit = globals()['phase_' + phase](data_dir)
+    wall = time.time() - start
+    print(json.dumps({'wall': wall, 'count': count, 'unit': unit}))
+
+
+def _profiles(data_dir):
+    from gtest.skeletons import find_profiles
+    skel_dir = pjoin(data_dir, 'grammar', 'tsdb', 'skeletons')
+    return find_profiles(skel_dir, None)
+
+
+def _work(data_dir, skel):
+    return pjoin(data_dir, 'work', os.path.basename(skel))
+
+
+def _gold(data_dir, skel):
+    return pjoin(data_dir, 'grammar', 'tsdb', 'gold', os.path.basename(skel))
+
+
+def phase_startup(data_dir):
+    import gtest.regression, gtest.coverage, gtest.semantics
+    return 0, ''
+
+
+def phase_discovery(data_dir):
+    from gtest.skeletons import prepare_profile_keypaths
+    args = argparse.Namespace(profiles=[], no_cache=True, cache_dir=None)
+    prepare_profile_keypaths(
+        args, pjoin(data_dir, 'grammar', 'tsdb', 'skeletons'), None
+    )
+    return len(args.profiles), 'profiles'
+
+
+def phase_header(data_dir):
+    from gtest.skeletons import print_profile_header
+    items = 0
+    stdout = sys.stdout
+    with open(os.devnull, 'w') as sys.stdout:
+        for skel in _profiles(data_dir):
+            print_profile_header(':' + os.path.basename(skel), skel)
+            items += _count_lines(pjoin(skel, 'item'))
+    sys.stdout = stdout
+    return items, 'items'
+
+
+def phase_parse(data_dir):
+    from gtest.util import (parse_profile, make_keypath)
+    args = argparse.Namespace(
+        shards=1, ace_pool=None, engine='art', art_opts=[], ace_opts=[],
+        preprocessor='', use_mkprof=False,
+        compiled_grammar=make_keypath(
+            pjoin(data_dir, 'grammar', 'image.dat'), ''
+        )
+    )
+    items = 0
+    with open(os.devnull, 'w') as log:
+        for skel in _profiles(data_dir):
+            parse_profile(skel, _work(data_dir, skel), args, log=log)
+            items += _count_lines(pjoin(skel, 'item'))
+    return items, 'items'
+
+
+def phase_coverage(data_dir):
+    from gtest.coverage import parsing_coverage
+    items = 0
+    for skel in _profiles(data_dir):
+        cov = parsing_coverage(_work(data_dir, skel))
+        items += cov['items'] + cov['*items'] + cov['?items']
+    return items, 'items'
+
+
+def phase_semantics(data_dir):
+    from gtest.semantics import semantic_test_result
+    results = 0
+    for skel in _profiles(data_dir):
+        res = semantic_test_result(_work(data_dir, skel))
+        results += res['result']
+    return results, 'results'
+
+
+def phase_compare(data_dir):
+    from gtest.regression import compare_mrs
+    items = 0
+    with open(os.devnull, 'w') as log:
+        for skel in _profiles(data_dir):
+            compare_mrs(_work(data_dir, skel), _gold(data_dir, skel), log=log)
+            items += _count_lines(pjoin(skel, 'item'))
+    return items, 'items'
+
+
+def _count_lines(path):
+    with open(path) as f:
+        return sum(1 for _ in f)
+
+
+if __name__ == '__main__':
+    main()
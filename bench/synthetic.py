@@ -0,0 +1,140 @@
+"""
+Synthetic [incr tsdb()] data for benchmarking gTest.
+
+Everything is derived from item ids so the stub executables in bench/bin
+can reproduce the rows of a gold profile without reading it: every
+tenth item is ungrammatical (i-wf 0) and has no readings, every 50th of
+the rest is ignored (i-wf 2), and grammatical items get the configured
+number of readings. Some MRSs are shared between items, as in real
+test suites.
+"""
+
+import os
+import json
+from os.path import join as pjoin
+
+
+RELATIONS = '''\
+item:
+  i-id :integer :key
+  i-origin :string
+  i-input :string
+  i-wf :integer
+  i-length :integer
+
+run:
+  run-id :integer :key
+  comment :string
+
+parse:
+  parse-id :integer :key
+  run-id :integer :key
+  i-id :integer :key
+  readings :integer
+  total :integer
+  tcpu :integer
+  tgc :integer
+  pedges :integer
+  aedges :integer
+  others :integer
+  error :string
+
+result:
+  parse-id :integer :key
+  result-id :integer
+  derivation :string
+  mrs :string
+'''
+
+PARSE_TABLES = ('run', 'parse', 'result')
+
+# names of distinct predicates; fewer means more MRSs shared by items
+VOCABULARY = 1000
+
+
+def load_config(path=None):
+    """
+    Return the benchmark configuration stored at *path*, or at the path
+    given by the GTEST_BENCH_CONFIG environment variable.
+    """
+    path = path or os.environ['GTEST_BENCH_CONFIG']
+    with open(path) as f:
+        return json.load(f)
+
+
+def item_wf(iid):
+    if iid % 10 == 0:
+        return 0
+    if iid % 50 == 1:
+        return 2
+    return 1
+
+
+def item_input(iid):
+    return 'the bench item {} parses {}'.format(iid, 'well' * (iid % 3))
+
+
+def readings(iid, max_readings):
+    return 0 if item_wf(iid) == 0 else max_readings
+
+
+def mrs(iid, rid, variant=0):
+    a = (iid + rid) % VOCABULARY
+    return (
+        '[ LTOP: h0 INDEX: e2 [ e SF: prop TENSE: pres ] RELS: < '
+        '[ _w{a}_v_1_rel<0:5> LBL: h1 ARG0: e2 ARG1: x3 [ x PERS: 3 ] ] '
+        '[ udef_q_rel<6:10> LBL: h4 ARG0: x3 RSTR: h5 BODY: h6 ] '
+        '[ _n{r}_n_{v}_rel<6:10> LBL: h7 ARG0: x3 ] > '
+        'HCONS: < h0 qeq h1 h5 qeq h7 > ]'
+    ).format(a=a, r=rid, v=variant + 1)
+
+
+def parse_row(iid, n):
+    return '{0}@1@{0}@{1}@10@9@0@{2}@{2}@{3}@'.format(
+        iid, n, 5 * (n + 1), 1000 * (n + 1)
+    )
+
+
+def result_rows(iid, n, variant=0):
+    for rid in range(n):
+        yield '{}@{}@(bench)@{}'.format(iid, rid, mrs(iid, rid, variant))
+
+
+def write_skeleton(path, start, size):
+    """
+    Write a skeleton with *size* items, starting at i-id *start*, to
+    the directory *path*.
+    """
+    os.makedirs(path)
+    with open(pjoin(path, 'relations'), 'w') as f:
+        f.write(RELATIONS)
+    with open(pjoin(path, 'item'), 'w') as f:
+        for iid in range(start, start + size):
+            text = item_input(iid)
+            f.write('{}@bench@{}@{}@{}\n'.format(
+                iid, text, item_wf(iid), len(text.split())
+            ))
+
+
+def write_parses(prof_path, max_readings, differ=0.0):
+    """
+    Write the parse tables of the profile at *prof_path*, which must
+    have an item table. If *differ* is greater than 0, that fraction of
+    items gets a different last reading (as gold profiles do when the
+    grammar changed).
+    """
+    every = int(round(1 / differ)) if differ > 0 else 0
+    with open(pjoin(prof_path, 'item')) as items, \
+            open(pjoin(prof_path, 'parse'), 'w') as parse, \
+            open(pjoin(prof_path, 'result'), 'w') as result:
+        for line in items:
+            iid = int(line.split('@', 1)[0])
+            n = readings(iid, max_readings)
+            parse.write(parse_row(iid, n) + '\n')
+            for rid, row in enumerate(result_rows(iid, n)):
+                if every and iid % every == every - 1 and rid == n - 1:
+                    row = '{}@{}@(bench)@{}'.format(iid, rid,
+                                                  mrs(iid, rid, variant=1))
+                result.write(row + '\n')
+    with open(pjoin(prof_path, 'run'), 'w') as f:
+        f.write('1@bench\n')
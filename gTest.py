@@ -1,11 +1,19 @@
 #!/usr/bin/env python3
 
 #from __future__ import print_function
+import os
 import sys
 import shlex
 import logging
 
-from gtest import (regression, coverage, semantics)
+from gtest import (
+    regression, coverage, semantics, performance, worker, timing, tsdb
+)
+from gtest.cache import (DEFAULT_CACHE_DIR, cache_path)
+from gtest.history import History
+from gtest.items import ItemFilter
+from gtest.exceptions import GTestError
+from gtest.util import Compressor
 
 if __name__ == '__main__':
     import argparse
@@ -56,6 +64,25 @@ if __name__ == '__main__':
            'profiles, compiled grammars, etc); if unset, a temp directory '
            'will be created'
     )
+    parser.add_argument(
+        '--tmpfs',
+        action='store_true',
+        help='create the temporary working directory (when -W is unset) '
+            'on tmpfs (/dev/shm); like other temporary working directories, '
+            'it is kept after the run for inspection'
+    )
+    parser.add_argument(
+        '--use-mkprof',
+        action='store_true',
+        help='prepare profiles with mkprof instead of linking skeleton '
+            'files in-process'
+    )
+    parser.add_argument(
+        '--compress',
+        action='store_true',
+        help='gzip the tables of working profiles in the background once '
+            'they have been tested'
+    )
     parser.add_argument(
         '-A', '--ace-config',
         default=':ace/config.tdl', metavar='[PATH|:RELPATH]',
@@ -66,8 +93,26 @@ if __name__ == '__main__':
         '-C', '--compiled-grammar',
         metavar='[PATH|:RELPATH]',
         help='location of a pre-compiled grammar image (RELPATH: '
-            '{grammar-dir}); if unset, the grammar will be compiled to a '
-            'temporary location'
+            '{grammar-dir}); if unset, the grammar image is taken from the '
+            'cache or compiled into it'
+    )
+    parser.add_argument(
+        '--cache-dir',
+        default=DEFAULT_CACHE_DIR, metavar='DIR',
+        help='directory for artifacts kept between runs, such as compiled '
+            'grammar images (default: {})'.format(DEFAULT_CACHE_DIR)
+    )
+    parser.add_argument(
+        '--cache-size',
+        type=int, default=4096, metavar='MB',
+        help='maximum size of cached grammar images; the least recently '
+            'used are removed first (default: 4096)'
+    )
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='always compile the grammar into the working directory '
+            'instead of using the image cache'
     )
     parser.add_argument(
         '-Y', '--yy-mode',
@@ -85,6 +130,67 @@ if __name__ == '__main__':
         help='additional options to give to ACE, given as a string '
             '(e.g. \'-n5 -Tq\')'
     )
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int, default=1, metavar='N',
+        help='test up to N profiles at once, starting with those that took '
+            'longest to parse before; results are still reported in '
+            'profile order (default: 1)'
+    )
+    parser.add_argument(
+        '--shards',
+        type=int, default=1, metavar='N',
+        help='split each skeleton into N parts that are parsed at once '
+            'by separate ACE processes and then merged (default: 1)'
+    )
+    parser.add_argument(
+        '--engine',
+        choices=('art', 'ace'),
+        default='art',
+        help='how profiles are parsed: "art" runs art and ACE for each '
+            'profile; "ace" keeps a pool of ACE processes running for the '
+            'whole test run (default: art)'
+    )
+    parser.add_argument(
+        '--items',
+        action='append', metavar='FILTER',
+        help='only test the items matching FILTER (may be repeated; all '
+            'must match): i-id ranges (e.g. 1000-1200 or 5,10-), wf=N[,...], '
+            'length=[MIN]-[MAX], input=REGEX, or "failed" for the items '
+            'that differed from gold in the last regression test'
+    )
+    parser.add_argument(
+        '--watch',
+        action='store_true',
+        help='after testing, keep running and test again when grammar '
+            'files (or the tested skeletons or gold profiles) change'
+    )
+    parser.add_argument(
+        '--workers',
+        metavar='HOST:PORT[,...]',
+        help='parse profiles on the given gTest workers (see the W '
+            'command) instead of locally; the tests are still run '
+            'locally, and -j is raised to the number of workers'
+    )
+    parser.add_argument(
+        '--item-timeout',
+        type=int, metavar='SECONDS',
+        help='stop parsing an item after SECONDS (given to ACE as '
+            '--timeout)'
+    )
+    parser.add_argument(
+        '--profile-timeout',
+        type=float, metavar='SECONDS',
+        help='kill the parser of a profile that is not done after SECONDS '
+            'and report the profile as timed out'
+    )
+    parser.add_argument(
+        '--timings',
+        metavar='FILE',
+        help='append a JSON record of the wall-clock time, CPU time, and '
+            'subprocess memory use of each phase of testing each profile '
+            'to FILE (one record per line)'
+    )
     # currently there's no good case for this, since necessary ones can
     # be guessed (e.g. -e) or given from other gTest options (-Y)
     # If enabled later, remove args.art_opts = [] below
@@ -148,6 +254,20 @@ if __name__ == '__main__':
         help='directory with [incr tsdb()] gold profiles (RELPATH: '
             '{grammar-dir}; default: :tsdb/gold/)'
     )
+    regr.add_argument(
+        '--incremental',
+        action='store_true',
+        help='reuse the recorded outcome of profiles whose grammar image, '
+            'skeleton, gold profile, and options are unchanged since they '
+            'were last tested with --incremental (not used with '
+            '--no-cache)'
+    )
+    regr.add_argument(
+        '--fail-fast',
+        action='store_true',
+        help='stop at the first item that differs from gold, stopping '
+            'any running parsers and skipping the remaining profiles'
+    )
     regr.set_defaults(test=regression)
 
     # Coverage tests
@@ -159,13 +279,16 @@ if __name__ == '__main__':
         help='parsing coverage',
         epilog='examples:\n'
             '  gTest -G ~/mygram C --list-profiles\n'
-            '  gTest -G ~/mygram C :abc'
+            '  gTest -G ~/mygram C :abc\n'
+            '  gTest -G ~/mygram C --generate :abc'
+    )
+    covr.add_argument(
+        '--generate',
+        action='store_true',
+        help='also test generation coverage by generating from the first '
+            'reading of each parsed item (--profile-timeout applies '
+            'separately to generation)'
     )
-    # covr.add_argument(
-    #     '--generate',
-    #     action='store_true',
-    #     help='also test generation coverage'
-    # )
     covr.set_defaults(test=coverage)
 
     # Semantic (MRS) tests
@@ -184,8 +307,93 @@ if __name__ == '__main__':
     #     action='store_true',
     #     help='also test generation coverage'
     # )
+    sem.add_argument(
+        '--persist-checks',
+        action='store_true',
+        help='remember the faults found in each distinct MRS in the cache '
+            'directory, so later runs only check MRSs not seen before'
+    )
+    sem.add_argument(
+        '--memo-size',
+        type=int, default=1000000, metavar='N',
+        help='maximum number of MRSs remembered by --persist-checks; the '
+            'least recently used are forgotten first (default: 1000000)'
+    )
     sem.set_defaults(test=semantics)
 
+    # Performance tests
+
+    perf = subparsers.add_parser(
+        'P',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        parents=[skel_parser],
+        help='performance regression test',
+        description='Compare the parsing cost (time, edges, and memory, as '
+            'recorded in the parse table) of the current grammar with a gold '
+            'profile, flagging significant increases. Gold profiles are '
+            'found as for regression tests.',
+        epilog='examples:\n'
+            '  gTest -G ~/mygram P --list-profiles\n'
+            '  gTest -G ~/mygram P --threshold 1.2 :abc'
+    )
+    perf.add_argument(
+        '--gold-dir',
+        default=':tsdb/gold', metavar='[DIR|:RELPATH]',
+        help='directory with [incr tsdb()] gold profiles (RELPATH: '
+            '{grammar-dir}; default: :tsdb/gold/)'
+    )
+    perf.add_argument(
+        '--metrics',
+        default=','.join(performance.DEFAULT_METRICS), metavar='FIELDS',
+        help='comma-separated parse table fields to compare (default: '
+            '{})'.format(','.join(performance.DEFAULT_METRICS))
+    )
+    perf.add_argument(
+        '--alpha',
+        type=float, default=0.05, metavar='P',
+        help='significance level for increases over gold (default: 0.05)'
+    )
+    perf.add_argument(
+        '--threshold',
+        type=float, default=1.1, metavar='RATIO',
+        help='ratio of test to gold totals above which a significant '
+            'increase is shown as a regression (red) rather than a '
+            'warning (yellow) (default: 1.1)'
+    )
+    perf.add_argument(
+        '--item-threshold',
+        type=float, default=2.0, metavar='RATIO',
+        help='log items whose value exceeds gold by this ratio '
+            '(default: 2.0)'
+    )
+    perf.set_defaults(test=performance)
+
+    # Parsing workers
+
+    work = subparsers.add_parser(
+        'W',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        help='parsing worker for distributed tests',
+        description='Listen for profiles sent by test runs with the '
+            '--workers option and parse them with art. Grammar images '
+            'received are kept in {cache-dir}/images. Workers do not '
+            'authenticate clients and run the ACE commands (including '
+            'preprocessors) they are sent, so only listen on trusted '
+            'networks.',
+        epilog='examples:\n'
+            '  gTest W --listen :7771 &\n'
+            '  gTest W --listen :7772 &\n'
+            '  gTest -G ~/mygram --workers :7771,:7772 R'
+    )
+    work.add_argument(
+        '--listen',
+        default='localhost:{}'.format(worker.DEFAULT_PORT),
+        metavar='[HOST]:PORT',
+        help='address to listen on (default: localhost:{})'
+            .format(worker.DEFAULT_PORT)
+    )
+    work.set_defaults(test=worker)
+
 
     args = parser.parse_args()
     logging.basicConfig(level=50-(args.verbosity*10))
@@ -199,10 +407,34 @@ if __name__ == '__main__':
     if args.yy_mode:
         args.ace_opts.append('-y')
         args.art_opts.append('-Y')
+    if args.items:
+        try:
+            args.items = ItemFilter(args.items)
+        except GTestError as ex:
+            parser.error(str(ex))
+    if args.item_timeout:
+        args.ace_opts.append('--timeout={}'.format(args.item_timeout))
 
     if args.color == 'never' or (args.color == 'auto' and not
                                  sys.stdout.isatty()):
         import gtest.util
         gtest.util.color = gtest.util.nocolor
 
-    args.test.run(args)
+    if args.timings:
+        timing.start(args.timings, test=args.test.__name__.split('.')[-1],
+                     grammar=os.path.abspath(args.grammar_dir))
+    args.compressor = Compressor() if args.compress else None
+    history = args.history = History(
+        None if args.no_cache else cache_path(args.cache_dir, 'history.json')
+    )
+    tsdb.load_order(
+        None if args.no_cache else cache_path(args.cache_dir, 'order.json')
+    )
+    try:
+        args.test.run(args)
+    finally:
+        history.close()
+        tsdb.save_order()
+        if args.compressor is not None:
+            args.compressor.close()
+        timing.stop()
@@ -0,0 +1,273 @@
+"""
+Persistent storage for artifacts that outlive a single gTest run.
+
+Everything here lives under a cache directory (by default
+~/.cache/gtest, or $XDG_CACHE_HOME/gtest) which may be shared by
+several concurrent runs, so writers should hold a file_lock() and
+replace files atomically, or use a database (as Memo does).
+"""
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from os.path import (
+    expanduser, relpath, join as pjoin, isdir, exists, getsize,
+    getmtime
+)
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # not on POSIX; locking is best-effort
+    fcntl = None
+
+
+DEFAULT_CACHE_DIR = pjoin(
+    os.environ.get('XDG_CACHE_HOME') or expanduser('~/.cache'),
+    'gtest'
+)
+
+
+def cache_path(cache_dir, *parts):
+    """
+    Return the path of *parts* under *cache_dir*, creating the
+    containing directory if necessary.
+    """
+    path = pjoin(cache_dir, *parts)
+    parent = os.path.dirname(path)
+    if not isdir(parent):
+        try:
+            os.makedirs(parent)
+        except OSError:
+            if not isdir(parent):  # another process may have made it
+                raise
+    return path
+
+
+@contextmanager
+def file_lock(path):
+    """
+    Hold an exclusive lock on the file at *path* (created if needed)
+    for the duration of the context.
+    """
+    with open(path, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def touch(path):
+    """
+    Mark the file at *path* as recently used.
+    """
+    os.utime(path, None)
+
+
+def hold(path):
+    """
+    Mark the file at *path* as in use, so that evict() (in this or
+    another run) does not remove it, until the returned file object is
+    closed or the process exits. This takes a shared lock on
+    `<path>.use.lock`; to not race with eviction, the file should be
+    checked for (or created) while holding file_lock() on
+    `<path>.lock`, as evict() does.
+    """
+    f = open(path + '.use.lock', 'a')
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+    return f
+
+
+# temporary files older than this (in seconds) are taken to be left
+# over by runs that died, and may be evicted
+TMP_MAX_AGE = 24 * 60 * 60
+
+
+def evict(directory, max_size, keep=()):
+    """
+    Remove the least recently used files in *directory* until the total
+    size of the remaining files is at most *max_size* bytes. Lock files,
+    temporary files still being written (by this or another run), files
+    held by hold(), and any paths in *keep* are never removed.
+    """
+    entries = []
+    now = time.time()
+    for fn in os.listdir(directory):
+        path = pjoin(directory, fn)
+        if fn.endswith('.lock') or path in keep or isdir(path):
+            continue
+        try:
+            mtime = getmtime(path)
+            if fn.endswith('.tmp') and now - mtime < TMP_MAX_AGE:
+                continue
+            entries.append((mtime, getsize(path), path))
+        except OSError:
+            continue  # removed by someone else
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            if _remove_unheld(path):
+                total -= size
+                logging.debug('Evicted from cache: {}'.format(path))
+        except OSError:
+            pass
+
+
+def _remove_unheld(path):
+    # remove the file at path unless it is held (see hold()); return
+    # True if it was removed
+    if not exists(path + '.use.lock'):
+        os.remove(path)
+        return True
+    with file_lock(path + '.lock'), open(path + '.use.lock', 'a') as f:
+        if fcntl is not None:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                return False  # in use
+        os.remove(path)
+        return True
+
+
+def hash_files(paths, extra=(), basedir=None):
+    """
+    Return a hex digest over the strings in *extra* and the names and
+    contents of the files at *paths*. If *basedir* is given, names are
+    taken relative to it so the digest does not depend on where the
+    files are checked out.
+    """
+    h = hashlib.sha1()
+    for s in extra:
+        h.update(s.encode('utf-8'))
+        h.update(b'\0')
+    for path in paths:
+        name = relpath(path, basedir) if basedir else path
+        h.update(name.encode('utf-8'))
+        h.update(b'\0')
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 16), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def load_json(path, default=None):
+    """
+    Return the JSON data stored at *path*, or *default* (an empty dict
+    if unset) if the file does not exist or cannot be read.
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {} if default is None else default
+
+
+def update_json(path, updates):
+    """
+    Merge the mapping *updates* into the JSON object stored at *path*.
+    The file is locked while it is read and atomically replaced, so
+    concurrent runs do not lose each other's entries.
+    """
+    with file_lock(path + '.lock'):
+        data = load_json(path)
+        data.update(updates)
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        os.rename(tmp, path)
+
+
+def string_key(s):
+    """
+    Return a hex digest of the string *s* for use as a cache key.
+    """
+    if not isinstance(s, bytes):
+        s = s.encode('utf-8')
+    return hashlib.sha1(s).hexdigest()
+
+
+class Memo(object):
+    """
+    A thread-safe mapping of string keys to JSON-serializable values,
+    kept in memory for a run. If *path* is given, entries are also
+    persisted to an SQLite database there: lookups that miss in memory
+    consult the database, and close() writes new entries and evicts the
+    least recently used ones beyond *max_entries*.
+    """
+
+    def __init__(self, path=None, max_entries=1000000):
+        self.path = path
+        self.max_entries = max_entries
+        self._data = {}
+        self._new = set()
+        self._used = set()
+        self._lock = threading.Lock()
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path, timeout=60,
+                                       check_same_thread=False)
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS memo '
+                '(key TEXT PRIMARY KEY, value TEXT, used REAL)'
+            )
+            self._db.commit()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._used.add(key)
+                return self._data[key]
+            if self._db is not None:
+                row = self._db.execute(
+                    'SELECT value FROM memo WHERE key = ?', (key,)
+                ).fetchone()
+                if row is not None:
+                    value = self._data[key] = json.loads(row[0])
+                    self._used.add(key)
+                    return value
+        return default
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._new.add(key)
+
+    def close(self):
+        """
+        Persist new entries and access times, evict old entries, and
+        close the database (if any).
+        """
+        if self._db is None:
+            return
+        with self._lock:
+            now = time.time()
+            db = self._db
+            db.executemany(
+                'INSERT OR REPLACE INTO memo VALUES (?, ?, ?)',
+                [(key, json.dumps(self._data[key]), now)
+                 for key in self._new]
+            )
+            db.executemany(
+                'UPDATE memo SET used = ? WHERE key = ?',
+                [(now, key) for key in self._used - self._new]
+            )
+            count = db.execute('SELECT COUNT(*) FROM memo').fetchone()[0]
+            if count > self.max_entries:
+                db.execute(
+                    'DELETE FROM memo WHERE key IN '
+                    '(SELECT key FROM memo ORDER BY used LIMIT ?)',
+                    (count - self.max_entries,)
+                )
+            db.commit()
+            db.close()
+            self._db = None
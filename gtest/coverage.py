@@ -1,22 +1,28 @@
 
-import re
+from collections import deque
 from functools import partial
-from os.path import (join as pjoin, basename, normpath, sep)
+from os.path import join as pjoin
 from subprocess import CalledProcessError
+from multiprocessing.pool import (ThreadPool, ApplyResult)
 
 from gtest.util import (
     prepare_working_directory, prepare_compiled_grammar,
     debug, info, warning, error, red, green, yellow,
-    check_exist, make_keypath, dir_is_profile,
-    mkprof, run_art
+    check_exist, make_keypath, dir_is_profile, profile_name, run_jobs,
+    parse_profile, finish_profile, time_limit
 )
 
+from gtest.engine import (prepare_engine, close_engine)
+from gtest.history import profile_cost
+from gtest.watch import watch
+from gtest.items import select_items
 from gtest.skeletons import (
     find_profiles, prepare_profile_keypaths,
-    print_profile_header
+    print_profile_header, profile_stats, profile_context, ProfileStats
 )
 
-from delphin import itsdb
+from gtest import (timing, tsdb)
+from gtest.exceptions import ProfileTimeout
 
 # thresholds
 PARSE_GOOD = 0.8
@@ -27,82 +33,154 @@ GENERATE_OK = 0.5
 def run(args):
     args.skel_dir = make_keypath(args.skel_dir, args.grammar_dir)
 
-    profile_match = partial(dir_is_profile, skeleton=True)
-    prepare_profile_keypaths(args, args.skel_dir.path, profile_match)
+    prepare_profile_keypaths(args, args.skel_dir.path, None)
 
     if args.list_profiles:
         print('\n'.join(map(lambda p: '{}\t{}'.format(p.key, p.path),
                             args.profiles)))
     else:
         prepare(args)  # note: args may change
-        coverage_test(args)
+        try:
+            coverage_test(args)
+            if args.watch:
+                watch(args, coverage_test)
+        finally:
+            close_engine(args)
 
 
 def prepare(args):
     prepare_working_directory(args)
     with open(pjoin(args.working_dir, 'ace.log'), 'w') as ace_log:
         prepare_compiled_grammar(args, ace_log=ace_log)
+    prepare_engine(args)
+    select_items(args)
 
 
 def coverage_test(args):
-    for skel in args.profiles:
-        name = skel.key
-        logf = pjoin(
-            args.working_dir,
-            'run-{}.log'.format(
-                '_'.join(normpath(re.sub(r'^:', '', name)).split(sep))
-            )
+    generator_pool = getattr(args, 'generator_pool', None)
+    args.generation = None
+    if generator_pool is not None:
+        # generation runs here while the next profiles are parsed
+        args.generation = ThreadPool(generator_pool.size)
+    try:
+        test = partial(coverage_job, args=args)
+        results = run_jobs(test, args.profiles, jobs=args.jobs,
+                           cost=profile_cost(args))
+        # print each profile as soon as it and those before it are done,
+        # without waiting on generation before parsing the next profile
+        pending = deque()
+        for skel, result in zip(args.profiles, results):
+            pending.append((skel, result))
+            while pending and _done(pending[0][1]):
+                print_coverage(*pending.popleft())
+        while pending:
+            print_coverage(*pending.popleft())
+    finally:
+        if generator_pool is not None:
+            args.generation.terminate()
+            args.generation.join()
+            args.generation = None
+
+
+def _done(result):
+    logf, cov = result
+    return not isinstance(cov, ApplyResult) or cov.ready()
+
+
+def print_coverage(skel, result):
+    logf, cov = result
+    if isinstance(cov, ApplyResult):
+        cov = cov.get()  # pending generation
+    name = skel.key
+
+    print_profile_header(name, skel.path)
+
+    if logf is None:
+        print('  Skeleton was not found: {}'.format(skel.path))
+    elif cov is None:
+        print('  There was an error processing the testsuite.')
+        print('  See {}'.format(logf))
+    elif isinstance(cov, ProfileTimeout):
+        print('  {}: {}'.format(yellow('Timeout'), cov))
+        print('  See {}'.format(logf))
+    else:
+        print_coverage_summary(name, cov)
+
+
+def coverage_job(skel, args):
+    """
+    Run the coverage test for a single skeleton. Return a pair of the
+    log file path (or `None` if the skeleton was not found) and the
+    coverage (or `None` if processing failed, or the ProfileTimeout if
+    parsing exceeded its time limit). If generation is also tested,
+    the coverage is the AsyncResult of generation_job() instead.
+    """
+    if not check_exist(skel.path):
+        return None, None
+    logf = pjoin(args.working_dir,
+                 'run-{}.log'.format(profile_name(skel.key)))
+    cov = None
+    with open(logf, 'w') as logfile, profile_context(skel):
+        try:
+            cov = test_coverage(skel, args, logfile)
+        except CalledProcessError:
+            pass
+        except ProfileTimeout as ex:
+            cov = ex
+    if isinstance(cov, dict) and args.generation is not None:
+        dest = pjoin(args.working_dir, profile_name(skel.key))
+        cov = args.generation.apply_async(
+            generation_job, (skel, dest, cov, args, logf)
         )
-        
-        print_profile_header(name, skel.path)
-
-        with open(logf, 'w') as logfile:
-            try:
-                cov = test_coverage(skel, args, logfile)
-                print_coverage_summary(name, cov)
-            except CalledProcessError:
-                print('  There was an error processing the testsuite.')
-                print('  See {}'.format(logf))
-            
+    return logf, cov
+
+
+def generation_job(skel, dest, pc, args, logf):
+    """
+    Test the generation coverage of the parsed profile at *dest*, given
+    its parsing coverage *pc*. Return the coverage, or `None` or the
+    ProfileTimeout as for coverage_job().
+    """
+    cov = None
+    with open(logf, 'a') as logfile, profile_context(skel):
+        try:
+            with time_limit(getattr(args, 'profile_timeout', None)), \
+                    timing.phase('generate'):
+                cov = generation_coverage(
+                    dest, pc, args.generator_pool,
+                    stats=profile_stats(skel.path), log=logfile
+                )
+        except CalledProcessError:
+            pass
+        except ProfileTimeout as ex:
+            cov = ex
+    finish_profile(dest, args)
+    return cov
+
 
 def test_coverage(skel, args, logfile):
     info('Coverage testing profile: {}'.format(skel.key))
 
     cov = {}
-    dest = pjoin(args.working_dir, basename(skel.path))
+    dest = pjoin(args.working_dir, profile_name(skel.key))
 
-    if not (check_exist(skel.path)):
-        print('  Skeleton was not found: {}'.format(skel.path))
-        return
+    parse_profile(skel.path, dest, args, log=logfile)
 
-    mkprof(skel.path, dest, log=logfile)
-    run_art(
-        args.compiled_grammar.path,
-        dest,
-        options=args.art_opts,
-        ace_preprocessor=args.preprocessor,
-        ace_options=args.ace_opts,
-        log=logfile
-    )
-
-    cov = parsing_coverage(dest)
-
-    # if args.generate:
-    #     g_dest = pjoin(args.working_dir, basename(skel.path) + '.g')
-    #     mkprof(skel.path, g_dest, log=logfile)
-    #     run_art(
-    #         args.compiled_grammar.path,
-    #         g_dest,
-    #         options=args.art_opts + ['-e', dest],
-    #         ace_preprocessor=args.preprocessor,
-    #         ace_options=args.ace_opts + ['-e'],
-    #         log=logfile
-    #     )
-    #     cov = generation_coverage(g_dest, cov)
+    with timing.phase('coverage'):
+        cov = parsing_coverage(dest, profile_stats(skel.path))
+    if getattr(args, 'generation', None) is None:
+        finish_profile(dest, args)  # otherwise after generation
     return cov
 
-def parsing_coverage(prof_path):
-    # todo: consider i-wf
+def parsing_coverage(prof_path, stats=None):
+    """
+    Return the parsing coverage counts of the profile at *prof_path*.
+    The i-wf of each item is taken from *stats* (the ProfileStats of
+    the profile's skeleton) so the `item` table is not read again, and
+    only the needed columns of `parse` are read, one row at a time.
+    """
+    if stats is None:
+        stats = ProfileStats(prof_path)
     cov =dict([
         ('items', 0), # items with i-wf = 1
         ('*items', 0), # items with i-wf = 0
@@ -112,10 +190,14 @@ def parsing_coverage(prof_path):
         ('readings', 0),
         ('*readings', 0)
     ])
-    prof = itsdb.ItsdbProfile(prof_path, index=False)
-    for row in prof.join('item', 'parse'):
-        wf = int(row['item:i-wf'])
-        readings = int(row['parse:readings'])
+    # a hash join of item (as stats.wf) and parse, streaming parse
+    wfs = stats.wf
+    for iid, readings in tsdb.iter_rows(prof_path, 'parse',
+                                        ['i-id', 'readings']):
+        wf = wfs.get(int(iid))
+        if wf is None:
+            continue  # not in the item table, so not in a join either
+        readings = int(readings)
         if wf == 0:
             cov['*items'] += 1
             if readings > 0:
@@ -131,8 +213,47 @@ def parsing_coverage(prof_path):
     return cov
 
 
-def generation_coverage(prof_path, pc):
+def generation_coverage(prof_path, pc, pool, stats=None, log=None):
+    """
+    Return the parsing coverage *pc* of the parsed profile at
+    *prof_path* with its generation coverage added. The MRS of the
+    first reading of each parsed item (as stored by the parse run, so
+    nothing is parsed again) is given to the ACE generators in *pool*
+    (see gtest.engine.AcePool), and the item counts as realized if
+    anything is generated from it.
+    """
+    if stats is None:
+        stats = ProfileStats(prof_path)
     cov = dict(pc)
+    cov.update([
+        ('has_realization', 0),
+        ('*has_realization', 0),
+        ('realizations', 0),
+        ('*realizations', 0)
+    ])
+    wfs = stats.wf
+    iids = dict((int(pid), int(iid)) for pid, iid
+                in tsdb.iter_rows(prof_path, 'parse', ['parse-id', 'i-id']))
+
+    def first_readings():
+        rows = tsdb.sorted_rows(prof_path, 'result', 'parse-id',
+                                ['parse-id', 'result-id', 'mrs'])
+        for pid, group in tsdb.group_rows(rows):
+            _, _, mrs = min(group, key=lambda row: int(row[1]))
+            iid = iids.get(pid)
+            if iid is not None and mrs.strip():
+                yield iid, mrs
+
+    for iid, sentences in pool.generate(first_readings(), log=log):
+        wf = wfs.get(iid)
+        if wf not in (0, 1):
+            continue  # not counted for parsing either
+        prefix = '*' if wf == 0 else ''
+        if sentences:
+            cov[prefix + 'has_realization'] += 1
+        else:
+            debug('No realizations for item {}'.format(iid), log)
+        cov[prefix + 'realizations'] += len(sentences)
     return cov
 
 
@@ -197,10 +318,57 @@ def print_coverage_summary(name, cov):
         cov['readings'], cov['has_parse'], s1,
         cov['*readings'], cov['*has_parse'], s2
     ))
-    #print('  realizations:')
+
+    if 'has_realization' in cov:
+        print_generation_summary(cov)
     print()
 
 
+def print_generation_summary(cov):
+    s1 = s2 = '(------)    '
+    if cov['has_parse']:
+        v1 = float(cov['has_realization']) / cov['has_parse']
+        s1 = pad(
+            '({s}){pad}',
+            '{: <6.4f}'.format(v1),
+            10,
+            color=choose_color(v1, GENERATE_OK, GENERATE_GOOD),
+        )
+    if cov['*has_parse']:
+        v2 = float(cov['*has_realization']) / cov['*has_parse']
+        s2 = pad(
+            '({s}){pad}',
+            '{: <6.4f}'.format(v2),
+            10
+        )
+    print(template2s.format(
+        'generates',
+        cov['has_realization'], cov['has_parse'], s1,
+        cov['*has_realization'], cov['*has_parse'], s2
+    ))
+
+    s1 = s2 = '(------)    '
+    if cov['has_realization']:
+        v1 = float(cov['realizations']) / cov['has_realization']
+        s1 = pad(
+            '({s}){pad}',
+            '{: <.4f}'.format(v1),
+            10
+        )
+    if cov['*has_realization']:
+        v2 = float(cov['*realizations']) / cov['*has_realization']
+        s2 = pad(
+            '({s}){pad}',
+            '{: <.4f}'.format(v2),
+            10
+        )
+    print(template2s.format(
+        'realizations',
+        cov['realizations'], cov['has_realization'], s1,
+        cov['*realizations'], cov['*has_realization'], s2
+    ))
+
+
 def pad(fmt, s, length, color=None):
     pad = length - len(s)
     if color is not None:
@@ -0,0 +1,303 @@
+from __future__ import print_function
+
+import time
+import threading
+import subprocess
+from os.path import join as pjoin, abspath
+from contextlib import contextmanager
+
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+
+from gtest.util import (
+    debug, warning, error, current_deadline, check_deadline, watchdog
+)
+from gtest.worker import (WorkerPool, parse_address)
+
+from delphin import itsdb
+from delphin.interfaces import ace
+
+
+# The ACE pool engine parses items in-process instead of running art, so
+# gTest writes the rows art would otherwise write. Only the columns used
+# by gTest's tests (and useful for debugging) are filled in.
+
+RUN_ID = 1
+
+
+def prepare_engine(args):
+    """
+    Start the parsing engine selected by `args.engine`. For the `ace`
+    engine, a pool of ACE processes is stored on `args.ace_pool`;
+    otherwise (or when a preprocessor is used, which only art
+    supports) `args.ace_pool` is `None` and profiles are parsed by art.
+
+    If `args.workers` is set, profiles are instead parsed (by art) on
+    the gTest workers it lists, through the gtest.worker.WorkerPool
+    stored on `args.worker_pool`, and `args.jobs` is raised to the
+    number of workers if it is lower.
+
+    If `args.generate` is set, a pool of ACE generator processes is
+    also stored on `args.generator_pool` (see gtest.coverage).
+    """
+    args.ace_pool = None
+    args.worker_pool = None
+    args.generator_pool = None
+    if getattr(args, 'generate', False):
+        args.generator_pool = AcePool(
+            args.compiled_grammar.path,
+            size=max(1, args.jobs),
+            # -y only affects parsing input
+            cmdargs=[opt for opt in args.ace_opts if opt != '-y'],
+            interface=AceGenerator
+        )
+    if getattr(args, 'workers', None):
+        addresses = [parse_address(a) for a in args.workers.split(',')
+                     if a.strip()]
+        if args.engine == 'ace':
+            warning('Workers parse with art; ignoring --engine ace.')
+        args.jobs = max(args.jobs, len(addresses))
+        args.worker_pool = WorkerPool(
+            addresses,
+            args.compiled_grammar.path,
+            size=max(1, args.jobs) * max(1, args.shards)
+        )
+    elif args.engine == 'ace':
+        if args.preprocessor:
+            warning('The ACE engine cannot use a preprocessor; '
+                    'falling back to art.')
+        else:
+            args.ace_pool = AcePool(
+                args.compiled_grammar.path,
+                size=max(1, args.jobs) * max(1, args.shards),
+                cmdargs=args.ace_opts
+            )
+
+
+def close_engine(args):
+    """
+    Stop any processes started by prepare_engine().
+    """
+    if getattr(args, 'ace_pool', None) is not None:
+        args.ace_pool.close()
+        args.ace_pool = None
+    if getattr(args, 'worker_pool', None) is not None:
+        args.worker_pool.close()
+        args.worker_pool = None
+    if getattr(args, 'generator_pool', None) is not None:
+        args.generator_pool.close()
+        args.generator_pool = None
+
+
+class AceGenerator(ace.AceGenerator):
+    """
+    An ACE generator process that raises IOError when ACE's output
+    ends, e.g. when it is killed by AcePool.terminate(). Without
+    `--tsdb-stdout` (ACE before 0.9.24), pyDelphin otherwise reads
+    empty lines forever, waiting for the `NOTE:` line ending a response.
+    """
+
+    def receive(self):
+        stdout = self._p.stdout
+        self._p.stdout = _Output(stdout)
+        try:
+            return ace.AceGenerator.receive(self)
+        finally:
+            self._p.stdout = stdout
+
+
+class _Output(object):
+    def __init__(self, f):
+        self._f = f
+
+    def readline(self):
+        line = self._f.readline()
+        if not line:
+            raise IOError('ACE output ended unexpectedly')
+        return line
+
+
+class AcePool(object):
+    """
+    A pool of ACE parser processes that stay alive (with the grammar
+    image loaded) for the whole run. Processes are started on demand,
+    up to *size* at once. For generator processes, *interface* is
+    `delphin.interfaces.ace.AceGenerator`.
+    """
+
+    def __init__(self, grm, size=1, cmdargs=None, interface=ace.AceParser):
+        self.grm = grm
+        self.size = size
+        self.cmdargs = list(cmdargs or [])
+        self.interface = interface
+        self._idle = Queue()
+        self._count = 0
+        self._parsers = set()  # all running parsers, idle or not
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def process(self):
+        """
+        Borrow an ACE process from the pool for the duration of the
+        context. A process that fails is closed rather than returned.
+        """
+        p = self._acquire()
+        try:
+            yield p
+        except:
+            self._discard(p)
+            raise
+        else:
+            self._idle.put(p)
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except Empty:
+            pass
+        with self._lock:
+            spawn = self._count < self.size
+            if spawn:
+                self._count += 1
+        if not spawn:
+            return self._idle.get()
+        debug('Starting ACE process for {}'.format(self.grm))
+        try:
+            # the interface may extend cmdargs, so give it a copy
+            p = self.interface(self.grm, cmdargs=list(self.cmdargs))
+        except:
+            with self._lock:
+                self._count -= 1
+            raise
+        with self._lock:
+            self._parsers.add(p)
+        return p
+
+    def _discard(self, p):
+        with self._lock:
+            self._count -= 1
+            self._parsers.discard(p)
+        try:
+            p._p.kill()
+            p._p.wait()
+        except OSError:
+            pass
+
+    def close(self):
+        """
+        Close all idle ACE processes in the pool.
+        """
+        while True:
+            try:
+                p = self._idle.get_nowait()
+            except Empty:
+                break
+            with self._lock:
+                self._count -= 1
+                self._parsers.discard(p)
+            try:
+                p.close()
+            except (IOError, OSError):
+                pass
+
+    def terminate(self):
+        """
+        Kill all ACE processes of the pool, including those in use; the
+        profiles they were parsing fail.
+        """
+        with self._lock:
+            parsers = list(self._parsers)
+        for p in parsers:
+            try:
+                p._p.kill()
+            except OSError:
+                pass
+
+    def parse_profile(self, prof_path, log=None):
+        """
+        Parse each item of the (freshly created) profile at *prof_path*
+        and write the `run`, `parse`, and `result` tables. If a deadline
+        is in effect (see gtest.util.time_limit()), the parser is killed
+        when it passes and ProfileTimeout is raised.
+        """
+        debug('Parsing profile with the ACE pool: {}'
+              .format(abspath(prof_path)), log)
+        prof = itsdb.ItsdbProfile(prof_path, index=False)
+        prof.write_table('run', [{'run-id': RUN_ID, 'comment': 'gTest'}])
+        parse_fields = prof.table_relations('parse')
+        result_fields = prof.table_relations('result')
+        limit = current_deadline()
+        check_deadline(limit)
+        try:
+            with self.process() as p, \
+                    open(pjoin(prof_path, 'parse'), 'w') as parse_tbl, \
+                    open(pjoin(prof_path, 'result'), 'w') as result_tbl:
+                if limit is not None:
+                    watchdog.watch(p._p, limit.at, group=False)
+                try:
+                    for item in prof.read_table('item', key_filter=False):
+                        parse, results = self._parse_item(p, item)
+                        print(itsdb.make_row(parse, parse_fields),
+                              file=parse_tbl)
+                        for res in results:
+                            print(itsdb.make_row(res, result_fields),
+                                  file=result_tbl)
+                finally:
+                    if limit is not None and watchdog.unwatch(p._p):
+                        error('Stopped ACE at the time limit', log)
+                        check_deadline(limit, expired=True)
+        except (IOError, OSError, ValueError, AssertionError):
+            error('ACE process failed while parsing {}'.format(prof_path),
+                  log)
+            raise subprocess.CalledProcessError(-1, 'ace -g ' + self.grm)
+        debug('Completed parsing. Output at {}'.format(prof_path), log)
+
+    def generate(self, inputs, log=None):
+        """
+        Generate from each MRS in *inputs*, an iterable of (key, MRS
+        string) pairs, and yield pairs of the key and the list of
+        realized sentences. The deadline (if any) is enforced as by
+        parse_profile().
+        """
+        limit = current_deadline()
+        check_deadline(limit)
+        try:
+            with self.process() as p:
+                if limit is not None:
+                    watchdog.watch(p._p, limit.at, group=False)
+                try:
+                    for key, mrs in inputs:
+                        response = p.interact(mrs)
+                        yield key, [res.get('SENT', '')
+                                    for res in response['RESULTS']]
+                finally:
+                    if limit is not None and watchdog.unwatch(p._p):
+                        error('Stopped ACE at the time limit', log)
+                        check_deadline(limit, expired=True)
+        except (IOError, OSError, ValueError, AssertionError):
+            error('ACE process failed while generating', log)
+            raise subprocess.CalledProcessError(-1, 'ace -e -g ' + self.grm)
+
+    def _parse_item(self, p, item):
+        iid = item['i-id']
+        start = time.time()
+        response = p.interact(item['i-input'])
+        total = int((time.time() - start) * 1000)
+        results = response['RESULTS']
+        parse = {
+            'parse-id': iid,
+            'run-id': RUN_ID,
+            'i-id': iid,
+            'readings': len(results),
+            'total': total,
+            'error': ' '.join(response['ERRORS'])
+        }
+        return parse, [
+            {'parse-id': iid,
+             'result-id': i,
+             'derivation': res.get('DERIV', ''),
+             'mrs': res.get('MRS', '')}
+            for i, res in enumerate(results)
+        ]
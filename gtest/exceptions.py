@@ -2,3 +2,7 @@
 class GTestError(Exception):
     """Base error class for gTest."""
     pass
+
+class ProfileTimeout(GTestError):
+    """Raised when a profile is not parsed within its time limit."""
+    pass
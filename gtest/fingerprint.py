@@ -0,0 +1,201 @@
+"""
+Canonical MRS fingerprints.
+
+A fingerprint is a digest of a canonical labelling of the graph of an
+MRS's EPs, variables, and constraints, so it does not depend on the
+names of its variables or the order of its EPs. Nodes are first
+partitioned by iterative (Weisfeiler-Lehman style) refinement of their
+labels; where that leaves nodes that cannot be told apart, one is
+individualized at a time and the partition refined again, and the
+least resulting labelled graph is digested. The graph has everything
+that delphin.mrs.compare.isomorphic() compares, and a bit more (role
+names, the TOP and INDEX, ICONS), so MRSs with equal fingerprints are
+isomorphic, while isomorphic MRSs with different fingerprints are only
+a missed shortcut.
+
+Highly symmetric MRSs could take long to label canonically; when the
+search gives up, the fingerprint of the refined partition is returned
+instead, marked by a leading `~` (see is_canonical()), and readings
+with such fingerprints are confirmed with isomorphic().
+"""
+
+import json
+import hashlib
+from collections import (defaultdict, Counter)
+
+from delphin.mrs.components import var_sort
+from delphin.mrs.compare import isomorphic
+
+# the most labellings tried for an MRS before giving up on a canonical one
+MAX_LABELLINGS = 64
+
+
+class _GiveUp(Exception):
+    pass
+
+
+def mrs_fingerprint(m):
+    """
+    Return the fingerprint of the Xmrs *m* as a hex string.
+    """
+    variables = set(m.variables())
+    labels = {}
+    for var in variables:
+        props = sorted('{}={}'.format(p, v)
+                       for p, v in m.properties(var).items())
+        labels[var] = '|'.join(['v' + var_sort(var)] + props)
+    for var, tag in ((m.top, 'TOP'), (m.index, 'INDEX'), (m.xarg, 'XARG')):
+        if var in labels:
+            labels[var] += '|' + tag
+
+    edges = []
+    for ep in m.eps():
+        nid, pred, label, args = ep[0], ep[1], ep[2], ep[3]
+        consts = sorted('{}={}'.format(role, val)
+                        for role, val in args.items()
+                        if val not in variables)
+        labels[nid] = '|'.join(['p' + pred.string] + consts)
+        edges.append((nid, 'LBL', label))
+        edges.extend((nid, role, val) for role, val in args.items()
+                     if val in variables)
+    edges.extend(m.hcons())
+    edges.extend(m.icons())
+    neighbors = defaultdict(list)
+    for src, rel, tgt in edges:
+        neighbors[src].append(('>' + rel, tgt))
+        neighbors[tgt].append(('<' + rel, src))
+
+    colors = _refine(_ranks(labels), neighbors)
+    try:
+        cert = _canonical(colors, labels, edges, neighbors, [MAX_LABELLINGS])
+    except _GiveUp:
+        return '~' + _digest(_certificate(colors, labels, edges, ranked=True))
+    return _digest(cert)
+
+
+def is_canonical(fp):
+    """
+    Return `True` if the fingerprint *fp* is from a canonical labelling,
+    so equal fingerprints need no confirmation.
+    """
+    return not fp.startswith('~')
+
+
+def _ranks(sigs):
+    # number the distinct signatures in sorted order, which depends only
+    # on the signatures, not on the names of the nodes
+    ranks = dict((s, i) for i, s in enumerate(sorted(set(sigs.values()))))
+    return dict((node, ranks[s]) for node, s in sigs.items())
+
+
+def _refine(colors, neighbors):
+    """
+    Refine the partition of nodes given by *colors* (a dictionary
+    mapping nodes to ranks) until it is stable.
+    """
+    count = len(set(colors.values()))
+    while True:
+        colors = _ranks(dict(
+            (node, (c, tuple(sorted((rel, colors[other])
+                                    for rel, other in neighbors[node]))))
+            for node, c in colors.items()
+        ))
+        num = len(set(colors.values()))
+        if num == count:
+            return colors
+        count = num
+
+
+def _canonical(colors, labels, edges, neighbors, budget):
+    """
+    Return the least certificate of the labellings of the nodes that
+    extend the stable partition *colors*, individualizing the nodes of
+    the smallest ambiguous cell in turn. Raise _GiveUp after *budget*
+    (a one-item list) labellings.
+    """
+    cells = defaultdict(list)
+    for node, c in colors.items():
+        cells[c].append(node)
+    ambiguous = [(len(nodes), c) for c, nodes in cells.items()
+                 if len(nodes) > 1]
+    if not ambiguous:
+        budget[0] -= 1
+        if budget[0] < 0:
+            raise _GiveUp()
+        return _certificate(colors, labels, edges)
+    target = min(ambiguous)[1]
+    best = None
+    for node in cells[target]:
+        individualized = dict(
+            (n, 2 * c + (0 if n == node else 1)) for n, c in colors.items()
+        )
+        cert = _canonical(_refine(individualized, neighbors),
+                          labels, edges, neighbors, budget)
+        if best is None or cert < best:
+            best = cert
+    return best
+
+
+def _certificate(colors, labels, edges, ranked=False):
+    """
+    Return the graph with nodes numbered by *colors* as a string. If
+    *ranked* is `True`, colors need not be distinct and nodes are
+    described by their color instead.
+    """
+    if ranked:
+        nodes = sorted((colors[n], labels[n]) for n in colors)
+    else:
+        nodes = [labels[n] for n in sorted(colors, key=colors.get)]
+    return json.dumps([
+        nodes,
+        sorted((colors[src], rel, colors[tgt]) for src, rel, tgt in edges)
+    ])
+
+
+def _digest(s):
+    if not isinstance(s, bytes):
+        s = s.encode('utf-8')
+    return hashlib.sha1(s).hexdigest()
+
+
+def match_fingerprints(test_readings, gold_readings, same=isomorphic):
+    """
+    Pair up readings from the lists of (fingerprint, mrs) pairs
+    *test_readings* and *gold_readings* whose fingerprints are equal.
+    Pairs whose fingerprints are not canonical (see is_canonical()) are
+    also confirmed to be the same by calling *same* on their MRSs.
+    Return a triple of (number shared, indices of unmatched test
+    readings, indices of unmatched gold readings).
+    """
+    available = Counter(fp for fp, _ in gold_readings if is_canonical(fp))
+    candidates = defaultdict(list)  # other fingerprints -> gold indices
+    for j, (fp, _) in enumerate(gold_readings):
+        if not is_canonical(fp):
+            candidates[fp].append(j)
+    test_rest = []
+    shared = 0
+    for i, (fp, mrs) in enumerate(test_readings):
+        if is_canonical(fp):
+            if available[fp] > 0:
+                available[fp] -= 1
+                shared += 1
+                continue
+        else:
+            for j in candidates.get(fp, ()):
+                if same(mrs, gold_readings[j][1]):
+                    candidates[fp].remove(j)
+                    shared += 1
+                    break
+            else:
+                test_rest.append(i)
+            continue
+        test_rest.append(i)
+    gold_rest = []
+    for j, (fp, _) in enumerate(gold_readings):
+        if is_canonical(fp):
+            if available[fp] > 0:
+                available[fp] -= 1
+                gold_rest.append(j)
+        elif j in candidates[fp]:
+            gold_rest.append(j)
+    return shared, test_rest, gold_rest
@@ -0,0 +1,74 @@
+"""
+Parsing history of profiles, used to schedule the longest first.
+
+The wall-clock time taken to parse each skeleton (and its number of
+items) is kept in the cache directory between runs. With more than one
+job, profiles expected to take longest are started first so that they
+do not end up running alone at the end of a test run; profiles that
+were not parsed before are estimated from their number of items.
+"""
+
+import threading
+from os.path import abspath
+
+from gtest import cache
+from gtest.skeletons import profile_stats
+
+
+class History(object):
+    """
+    Past parse durations of skeletons, read from the JSON file at
+    *path* (if given) and updated there by close().
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._data = {} if path is None else cache.load_json(path)
+        self._new = {}
+        self._lock = threading.Lock()
+
+    def record(self, skel_path, seconds):
+        """
+        Record that parsing the skeleton at *skel_path* took *seconds*.
+        """
+        key = abspath(skel_path)
+        entry = {'seconds': seconds, 'items': profile_stats(skel_path).items}
+        with self._lock:
+            self._data[key] = self._new[key] = entry
+
+    def expected(self, skel_path):
+        """
+        Return the expected number of seconds to parse the skeleton at
+        *skel_path*: its last recorded duration, or an estimate from its
+        number of items and the average time per item of the recorded
+        skeletons (or 1 second per item if there are none).
+        """
+        with self._lock:
+            entry = self._data.get(abspath(skel_path))
+            if entry is not None:
+                return entry['seconds']
+            seconds = sum(e['seconds'] for e in self._data.values())
+            items = sum(e['items'] for e in self._data.values())
+        rate = seconds / items if items and seconds else 1.0
+        return profile_stats(skel_path).items * rate
+
+    def close(self):
+        """
+        Write the durations recorded in this run (if *path* was given).
+        """
+        with self._lock:
+            if self.path is not None and self._new:
+                cache.update_json(self.path, self._new)
+            self._new = {}
+
+
+def profile_cost(args):
+    """
+    Return a function giving the expected duration of testing a
+    skeleton KeyPath according to `args.history` (the *cost* argument
+    of gtest.util.run_jobs()), or `None` if there is no history.
+    """
+    history = getattr(args, 'history', None)
+    if history is None:
+        return None
+    return lambda skel: history.expected(skel.path)
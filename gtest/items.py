@@ -0,0 +1,212 @@
+"""
+Item selection: testing only some of the items of each skeleton.
+
+Filters given with `--items` select items by their fields or by
+whether they differed from gold in the last regression test of the
+profile; an item is selected if it matches every filter. For each
+profile, a skeleton with only the selected items is written to the
+working directory and tested in place of the full skeleton, and the
+regression test only compares the selected items with gold.
+
+Filters:
+
+  ID[-ID][,...]        i-id ranges, e.g. `1000-1200`, `5,10-20`, or
+                       `1000-` (open-ended)
+  wf=N[,...]           i-wf values, e.g. `wf=1`
+  length=[MIN]-[MAX]   i-length bounds (or `length=N`)
+  input=REGEX          i-input containing a match of REGEX
+  failed               items that differed from gold in the last
+                       regression test of the profile
+"""
+
+import re
+from os.path import (abspath, relpath, join as pjoin, pardir)
+
+from gtest import (cache, tsdb)
+from gtest.exceptions import GTestError
+from gtest.util import (
+    debug, info, warning, profile_name, filter_skeleton
+)
+from gtest.skeletons import forget_profile_stats
+
+from delphin import itsdb
+
+
+class ItemFilter(object):
+    """
+    The conjunction of the filters in the list of strings *specs*.
+    Raises GTestError if a filter is invalid.
+    """
+
+    def __init__(self, specs):
+        self.specs = list(specs)
+        self.failed = False
+        self._tests = []  # (column, predicate on the unescaped value)
+        for spec in self.specs:
+            self._add(spec.strip())
+
+    def _add(self, spec):
+        name, sep, value = spec.partition('=')
+        try:
+            if spec == 'failed':
+                self.failed = True
+            elif not sep:
+                self._tests.append(('i-id', _in_ranges(_ranges(spec))))
+            elif name == 'wf':
+                wfs = set(int(x) for x in value.split(','))
+                self._tests.append(('i-wf', lambda v: int(v) in wfs))
+            elif name == 'length':
+                self._tests.append(('i-length', _in_ranges(_ranges(value))))
+            elif name == 'input':
+                regex = re.compile(value)
+                self._tests.append(
+                    ('i-input', lambda v: regex.search(v) is not None)
+                )
+            else:
+                raise ValueError(name)
+        except (ValueError, re.error):
+            raise GTestError('Invalid item filter: {}'.format(spec))
+
+    def predicate(self, fields, failed=()):
+        """
+        Return a function that is called with the (escaped) values of a
+        row of the item table, whose columns are *fields*, and returns
+        `True` if the item is selected. *failed* are the i-ids of the
+        items that failed the last regression test.
+        """
+        iid_idx = fields.index('i-id')
+        tests = [(fields.index(col), test) for col, test in self._tests]
+        unescape = itsdb.unescape
+        failed = set(failed)
+
+        def keep(cells):
+            if self.failed and int(cells[iid_idx]) not in failed:
+                return False
+            try:
+                return all(test(unescape(cells[i])) for i, test in tests)
+            except ValueError:  # e.g. an empty i-length
+                return False
+        return keep
+
+
+def _ranges(s):
+    ranges = []
+    for part in s.split(','):
+        lo, sep, hi = part.partition('-')
+        lo = int(lo) if lo.strip() else None
+        hi = int(hi) if hi.strip() else None
+        if not sep:
+            hi = lo
+        if lo is None and hi is None:
+            raise ValueError(s)
+        ranges.append((lo, hi))
+    return ranges
+
+
+def _in_ranges(ranges):
+    def test(value):
+        x = int(value)
+        return any((lo is None or lo <= x) and (hi is None or x <= hi)
+                   for lo, hi in ranges)
+    return test
+
+
+def select_items(args):
+    """
+    If `args.items` (an ItemFilter) is set, replace each skeleton in
+    `args.profiles` with one that has only the selected items, written
+    under the working directory in the same layout as `args.skel_dir`
+    (which is changed to point there, so gold profiles are still found
+    by relative path). Profiles without selected items are dropped.
+    `args.selections` maps each new skeleton path to the original path
+    and the set of selected i-ids, and `args.unfiltered` keeps the
+    original profiles and skeleton directory (e.g. for gtest.watch to
+    watch them and select again).
+    """
+    args.selections = {}
+    if getattr(args, 'items', None) is None:
+        return
+    args.unfiltered = (args.profiles, args.skel_dir)
+    # parse durations of partial skeletons would mislead the scheduling
+    # of later runs (see gtest.history)
+    args.history = None
+    failures = load_failures(args) if args.items.failed else {}
+    if args.items.failed and args.no_cache:
+        warning('Failed items are not recorded with --no-cache.')
+    skel_root = abspath(args.skel_dir.path)
+    sel_root = pjoin(args.working_dir, 'skeletons')
+    profiles = []
+    for skel in args.profiles:
+        path = abspath(skel.path)
+        rel = relpath(path, skel_root)
+        if rel.startswith(pardir):
+            rel = profile_name(skel.key)  # given from outside skel-dir
+        dest = pjoin(sel_root, rel)
+        fields = tsdb.table_fields(path, 'item')
+        keep = args.items.predicate(fields, failures.get(path, ()))
+        iids = set()
+        iid_idx = fields.index('i-id')
+
+        def select(cells):
+            if keep(cells):
+                iids.add(int(cells[iid_idx]))
+                return True
+            return False
+
+        filter_skeleton(path, dest, select)
+        forget_profile_stats(dest)  # it may have been tested before
+        if not iids:
+            info('No items selected in {}; skipping.'.format(skel.key))
+            continue
+        debug('Selected {} items of {}'.format(len(iids), skel.key))
+        args.selections[dest] = (path, iids)
+        profiles.append(skel._replace(path=dest))
+    if args.profiles and not profiles:
+        warning('No items were selected by --items.')
+    args.profiles = profiles
+    args.skel_dir = args.skel_dir._replace(path=sel_root)
+
+
+def selection(args, skel_path):
+    """
+    Return the original skeleton path and the set of selected i-ids
+    (`None` for all) of the skeleton at *skel_path* (see
+    select_items()).
+    """
+    return getattr(args, 'selections', {}).get(skel_path, (skel_path, None))
+
+
+#
+# FAILED ITEMS
+#
+
+def _failures_path(args):
+    return cache.cache_path(args.cache_dir, 'failures.json')
+
+
+def load_failures(args):
+    """
+    Return a dictionary mapping skeleton paths to the i-ids of the
+    items that failed their last regression test.
+    """
+    if args.no_cache:
+        return {}
+    return cache.load_json(_failures_path(args))
+
+
+def record_failures(args, skel_path, failed, selected=None):
+    """
+    Record the i-ids *failed* as the failed items of the skeleton at
+    *skel_path*. If only the i-ids *selected* were tested, the recorded
+    failures of other items are kept. (The regression test reports
+    parse-ids, which art numbers by i-id.)
+    """
+    if args.no_cache:
+        return
+    path = _failures_path(args)
+    skel_path = abspath(skel_path)
+    failed = set(failed)
+    if selected is not None:
+        previous = cache.load_json(path).get(skel_path, [])
+        failed.update(i for i in previous if i not in selected)
+    cache.update_json(path, {skel_path: sorted(failed)})
@@ -0,0 +1,239 @@
+
+from math import sqrt, erfc
+from functools import partial
+from subprocess import CalledProcessError
+from os.path import (abspath, join as pjoin)
+
+from gtest.util import (
+    prepare_working_directory, prepare_compiled_grammar,
+    debug, info, warning, error, red, green, yellow,
+    check_exist, make_keypath, profile_name, run_jobs, parse_profile,
+    finish_profile
+)
+from gtest import (timing, tsdb)
+from gtest.exceptions import ProfileTimeout
+from gtest.engine import (prepare_engine, close_engine)
+from gtest.history import profile_cost
+from gtest.watch import watch
+from gtest.items import select_items
+from gtest.regression import (gold_path, skel_has_gold)
+from gtest.skeletons import (
+    prepare_profile_keypaths, profile_index, profile_context,
+    print_profile_header
+)
+
+# parse table fields compared by default (those missing from either
+# profile are skipped): times in msec, edges, and memory in bytes
+DEFAULT_METRICS = ('total', 'tcpu', 'tgc', 'pedges', 'aedges', 'others')
+
+def run(args):
+    args.skel_dir = make_keypath(args.skel_dir, args.grammar_dir)
+    args.gold_dir = make_keypath(args.gold_dir, args.grammar_dir)
+
+    profile_match = partial(
+        skel_has_gold,
+        skel_dir=abspath(args.skel_dir.path),
+        gold_dir=abspath(args.gold_dir.path),
+        gold_index=profile_index(args.gold_dir.path, args)
+    )
+    prepare_profile_keypaths(args, args.skel_dir.path, profile_match)
+
+    if args.list_profiles:
+        print('\n'.join(map(lambda p: '{}\t{}'.format(p.key, p.path),
+                            args.profiles)))
+    else:
+        prepare(args)  # note: args may change
+        try:
+            performance_test(args)
+            if args.watch:
+                watch(args, performance_test)
+        finally:
+            close_engine(args)
+
+
+def prepare(args):
+    prepare_working_directory(args)
+    with open(pjoin(args.working_dir, 'ace.log'), 'w') as ace_log:
+        prepare_compiled_grammar(args, ace_log=ace_log)
+    prepare_engine(args)
+    select_items(args)
+    args.metrics = [m.strip() for m in args.metrics.split(',') if m.strip()]
+
+
+def performance_test(args):
+    test = partial(performance_job, args=args)
+    results = run_jobs(test, args.profiles, jobs=args.jobs,
+                       cost=profile_cost(args))
+    for skel, (logf, perf) in zip(args.profiles, results):
+        name = skel.key
+
+        print_profile_header(name, skel.path)
+
+        if logf is None:
+            print('  Skeleton or gold profile was not found: {}'
+                  .format(skel.path))
+        elif perf is None:
+            print('  There was an error processing the testsuite.')
+            print('  See {}'.format(logf))
+        elif isinstance(perf, ProfileTimeout):
+            print('  {}: {}'.format(yellow('Timeout'), perf))
+            print('  See {}'.format(logf))
+        else:
+            print_performance_summary(name, perf, args)
+
+
+def performance_job(skel, args):
+    """
+    Run the performance test for a single skeleton. Return a pair of
+    the log file path (or `None` if the skeleton or its gold profile
+    was not found) and the comparison (or `None` if processing failed,
+    or the ProfileTimeout if parsing exceeded its time limit).
+    """
+    gold = gold_path(skel.path, args.skel_dir.path, args.gold_dir.path)
+    if not (check_exist(skel.path) and check_exist(gold)):
+        return None, None
+    logf = pjoin(args.working_dir,
+                 'run-{}.log'.format(profile_name(skel.key)))
+    perf = None
+    with open(logf, 'w') as logfile, profile_context(skel):
+        try:
+            perf = test_performance(skel, gold, args, logfile)
+        except CalledProcessError:
+            pass
+        except ProfileTimeout as ex:
+            perf = ex
+    return logf, perf
+
+
+def test_performance(skel, gold, args, logfile):
+    info('Performance testing profile: {}'.format(skel.key))
+
+    dest = pjoin(args.working_dir, profile_name(skel.key))
+
+    parse_profile(skel.path, dest, args, log=logfile)
+
+    with timing.phase('performance'):
+        perf = compare_performance(
+            dest, gold, args.metrics,
+            item_threshold=args.item_threshold, log=logfile
+        )
+    finish_profile(dest, args)
+    return perf
+
+
+def compare_performance(dest_dir, gold_dir, metrics, item_threshold=None,
+                        log=None):
+    """
+    Compare the *metrics* (columns of the parse table) of the profile
+    at *dest_dir* to those of the gold profile at *gold_dir*, item by
+    item. Return a dictionary mapping each metric found in both
+    profiles to a dictionary with the number of compared items, the
+    test and gold totals, and the p-value of a one-sided signed-rank
+    test that the test values are greater. Items whose value is more
+    than *item_threshold* times the gold value are logged to *log*.
+    """
+    debug('Comparing performance ({}) to gold ({})'
+          .format(dest_dir, gold_dir), log)
+    fields = set(tsdb.table_fields(dest_dir, 'parse'))
+    fields.intersection_update(tsdb.table_fields(gold_dir, 'parse'))
+    metrics = [m for m in metrics if m in fields]
+    columns = ['i-id'] + metrics
+    matched = tsdb.merge_join(
+        tsdb.group_rows(tsdb.sorted_rows(dest_dir, 'parse', 'i-id', columns)),
+        tsdb.group_rows(tsdb.sorted_rows(gold_dir, 'parse', 'i-id', columns))
+    )
+    diffs = dict((m, []) for m in metrics)
+    totals = dict((m, [0, 0]) for m in metrics)
+    for iid, test_rows, gold_rows in matched:
+        if not (test_rows and gold_rows):
+            continue
+        for i, metric in enumerate(metrics, 1):
+            t, g = _value(test_rows[0][i]), _value(gold_rows[0][i])
+            if t is None or g is None:
+                continue  # not recorded (e.g. by the ACE engine)
+            diffs[metric].append(t - g)
+            totals[metric][0] += t
+            totals[metric][1] += g
+            if item_threshold is not None and t > g * item_threshold > 0:
+                info('{}\t{}\t{} -> {} ({:.2f}x)'
+                     .format(iid, metric, g, t, t / float(g)), log)
+    perf = {}
+    for metric in metrics:
+        if not diffs[metric]:
+            continue
+        perf[metric] = {
+            'items': len(diffs[metric]),
+            'test': totals[metric][0],
+            'gold': totals[metric][1],
+            'p': signed_rank_test(diffs[metric])
+        }
+        debug('{}\t{}'.format(metric, perf[metric]), log)
+    return perf
+
+
+def _value(s):
+    # empty or negative values mean the field was not recorded
+    try:
+        x = int(s)
+    except ValueError:
+        return None
+    return x if x >= 0 else None
+
+
+def signed_rank_test(diffs):
+    """
+    Return the p-value of a one-sided Wilcoxon signed-rank test that the
+    paired differences *diffs* tend to be positive, using the normal
+    approximation with corrections for ties and continuity.
+    """
+    diffs = [d for d in diffs if d != 0]
+    n = len(diffs)
+    if n == 0:
+        return 1.0
+    diffs.sort(key=abs)
+    w_plus = 0.0
+    tie_correction = 0.0
+    i = 0
+    while i < n:
+        j = i
+        while j + 1 < n and abs(diffs[j + 1]) == abs(diffs[i]):
+            j += 1
+        rank = (i + j) / 2.0 + 1  # average rank of the tied values
+        w_plus += rank * sum(1 for d in diffs[i:j + 1] if d > 0)
+        t = j - i + 1
+        tie_correction += t ** 3 - t
+        i = j + 1
+    mean = n * (n + 1) / 4.0
+    var = n * (n + 1) * (2 * n + 1) / 24.0 - tie_correction / 48.0
+    if var <= 0:
+        return 1.0
+    z = (w_plus - mean - 0.5) / sqrt(var)
+    return 0.5 * erfc(z / sqrt(2))
+
+
+template = '  {:12s}: {:>12} {:>12}  {}  {}'
+
+def print_performance_summary(name, perf, args):
+    if not perf:
+        print('  No comparable items.')
+        return
+    print(template.format('', 'test', 'gold', 'ratio   ', 'p-value'))
+    for metric in args.metrics:
+        if metric not in perf:
+            continue
+        m = perf[metric]
+        if m['gold']:
+            ratio = float(m['test']) / m['gold']
+            r = '{: <8.4f}'.format(ratio)
+        else:
+            ratio = None
+            r = '(------)'
+        significant = m['p'] < args.alpha
+        if significant and ratio is not None and ratio > 1:
+            r = (red if ratio > args.threshold else yellow)(r)
+        else:
+            r = green(r)
+        print(template.format(
+            metric, m['test'], m['gold'], r, '{:.4f}'.format(m['p'])
+        ))
+    print()
@@ -1,20 +1,33 @@
 import os
+import json
+import shutil
+import threading
 from functools import partial
+from subprocess import CalledProcessError
 from os.path import (
-    abspath, relpath, basename, join as pjoin, exists
+    abspath, relpath, basename, join as pjoin, exists, isfile
 )
 
 from gtest.util import (
     prepare_working_directory, prepare_compiled_grammar,
     debug, info, warning, error, red, green, yellow,
-    check_exist, make_keypath,
-    mkprof, run_art
+    check_exist, make_keypath, profile_name, run_jobs, grammar_key,
+    parse_profile, terminate_processes, finish_profile
+)
+from gtest import (cache, timing, tsdb)
+from gtest.exceptions import ProfileTimeout
+from gtest.sidecar import (GoldSidecar, load_state)
+from gtest.fingerprint import (mrs_fingerprint, match_fingerprints)
+from gtest.engine import (prepare_engine, close_engine)
+from gtest.history import profile_cost
+from gtest.watch import watch
+from gtest.items import (select_items, selection, record_failures)
+from gtest.skeletons import (
+    find_profiles, prepare_profile_keypaths, profile_index, profile_context
 )
-from gtest.skeletons import (find_profiles, prepare_profile_keypaths)
 
-from delphin import itsdb
 from delphin.mrs import simplemrs
-from delphin.mrs.compare import compare_bags
+from delphin.mrs.compare import (compare_bags, isomorphic)
 
 
 def run(args):
@@ -24,7 +37,8 @@ def run(args):
     profile_match = partial(
         skel_has_gold,
         skel_dir=abspath(args.skel_dir.path),
-        gold_dir=abspath(args.gold_dir.path)
+        gold_dir=abspath(args.gold_dir.path),
+        gold_index=profile_index(args.gold_dir.path, args)
     )
     prepare_profile_keypaths(args, args.skel_dir.path, profile_match)
 
@@ -33,48 +47,189 @@ def run(args):
                             args.profiles)))
     else:
         prepare(args)  # note: args may change
-        regression_test(args)
+        try:
+            regression_test(args)
+            if args.watch:
+                watch(args, regression_test)
+        finally:
+            close_engine(args)
 
 
 def prepare(args):
     prepare_working_directory(args)
     with open(pjoin(args.working_dir, 'ace.log'), 'w') as ace_log:
         prepare_compiled_grammar(args, ace_log=ace_log)
+    prepare_engine(args)
+    select_items(args)
 
 
 def regression_test(args):
-    for skel in args.profiles:
-        name = skel.key
-        if name.startswith(':'):
-            name = name[1:]
-
-        info('Regression testing profile: {}'.format(skel.key))
-
-        dest = pjoin(args.working_dir, basename(skel.path))
-        logf = pjoin(args.working_dir, 'run-{}.log'.format(name))
-
-        gold = gold_path(skel.path, args.skel_dir.path, args.gold_dir.path)
-
-        pass_msg = '{}\t{}'.format(green('pass'), skel.key)
-        fail_msg = '{}\t{}; See {}'.format(red('fail'), skel.key, logf)
-        skip_msg = '{}\t{}; See {}'.format(yellow('skip'), skel.key, logf)
-
-        if not (check_exist(skel.path) and check_exist(gold)):
-            print(skip_msg)
-            continue
-        
-        with open(logf, 'w') as logfile:
-            mkprof(skel.path, dest, log=logfile)
-            run_art(
-                args.compiled_grammar.path,
-                dest,
-                options=args.art_opts,
-                ace_preprocessor=args.preprocessor,
-                ace_options=args.ace_opts,
-                log=logfile
+    manifest = None
+    if args.incremental and args.items is not None:
+        warning('--incremental is not used with --items.')
+    elif args.incremental and args.no_cache:
+        warning('--incremental is not used with --no-cache.')
+    elif args.incremental:
+        manifest_path = cache.cache_path(args.cache_dir, 'manifest.json')
+        manifest = cache.load_json(manifest_path)
+    cancel = threading.Event() if args.fail_fast else None
+    test = partial(test_regression, args=args, manifest=manifest,
+                   cancel=cancel)
+    try:
+        for msg in run_jobs(test, args.profiles, jobs=args.jobs,
+                            cost=profile_cost(args)):
+            print(msg)
+        if cancel is not None and cancel.is_set() and args.watch:
+            # the parsing engine was terminated; restart it for reruns
+            close_engine(args)
+            prepare_engine(args)  # note: args may change
+    finally:
+        if manifest is not None:
+            cache.update_json(manifest_path, manifest)
+
+
+def test_regression(skel, args, manifest=None, cancel=None):
+    """
+    Parse and compare a single skeleton with its gold profile. Return
+    the message to be printed for the profile.
+
+    If *manifest* is given, it maps skeleton paths to the run key and
+    outcome of a previous run; the recorded outcome is reused when the
+    key is unchanged, and otherwise the new outcome is recorded.
+
+    If *cancel* (a threading.Event) is given, the comparison stops at
+    the first mismatching item, and the event is set to cancel the
+    remaining profiles and stop any running parsers (as it is for a
+    failure reused from *manifest*). The failure is still recorded in
+    *manifest*.
+    """
+    name = profile_name(skel.key)
+
+    info('Regression testing profile: {}'.format(skel.key))
+
+    dest = pjoin(args.working_dir, name)
+    logf = pjoin(args.working_dir, 'run-{}.log'.format(name))
+
+    gold = gold_path(skel.path, args.skel_dir.path, args.gold_dir.path)
+
+    pass_msg = '{}\t{}'.format(green('pass'), skel.key)
+    fail_msg = '{}\t{}; See {}'.format(red('fail'), skel.key, logf)
+    skip_msg = '{}\t{}; See {}'.format(yellow('skip'), skel.key, logf)
+    cancel_msg = '{}\t{} (cancelled)'.format(yellow('skip'), skel.key)
+    timeout_msg = '{}\t{}; See {}'.format(yellow('timeout'), skel.key, logf)
+
+    if cancel is not None and cancel.is_set():
+        return cancel_msg
+
+    if not (check_exist(skel.path) and check_exist(gold)):
+        return skip_msg
+
+    if manifest is not None:
+        entry_id = abspath(skel.path)
+        key = run_key(skel.path, gold, args)
+        entry = manifest.get(entry_id, {})
+        if entry.get('key') == key:
+            info('Profile unchanged since last run: {}'.format(skel.key))
+            if entry['success']:
+                return '{}\t{} (unchanged)'.format(green('pass'), skel.key)
+            if cancel is not None:
+                cancel_run(args, cancel)
+            if entry.get('log') and exists(entry['log']):
+                return '{}\t{} (unchanged); See {}'.format(
+                    red('fail'), skel.key, entry['log']
+                )
+            return '{}\t{} (unchanged)'.format(red('fail'), skel.key)
+
+    failures = []
+    with open(logf, 'w') as logfile, profile_context(skel):
+        try:
+            parse_profile(skel.path, dest, args, log=logfile)
+        except ProfileTimeout:
+            return timeout_msg
+        except CalledProcessError:
+            if cancel is not None and cancel.is_set():
+                return cancel_msg  # the parser was stopped
+            raise
+        cache_dir = None if args.no_cache else args.cache_dir
+        source, selected = selection(args, skel.path)
+        with timing.phase('compare'):
+            success = compare_mrs(
+                dest, gold, log=logfile,
+                cache_dir=cache_dir,
+                failures=failures,
+                fail_fast=cancel is not None,
+                gold_groups=(gold_in_memory(gold, cache_dir)
+                             if args.watch else None),
+                keys=selected
             )
-            success = compare_mrs(dest, gold, log=logfile)
-            print(pass_msg if success else fail_msg)
+        finish_profile(dest, args)
+        if cancel is None:  # otherwise the failures are incomplete
+            record_failures(args, source, failures, selected=selected)
+
+    if manifest is not None:
+        # a failure found with fail-fast is as final as any other
+        manifest[entry_id] = {
+            'key': key,
+            'success': success,
+            'log': None if success else keep_log(args, skel, logf)
+        }
+
+    if cancel is not None and not success:
+        cancel_run(args, cancel)
+        return '{}\t{} (item {}); See {}'.format(
+            red('fail'), skel.key, failures[0], logf
+        )
+
+    return pass_msg if success else fail_msg
+
+
+def keep_log(args, skel, logf):
+    """
+    Copy the log file *logf* of testing *skel* into the cache directory,
+    where it outlives the working directory, and return the copy's path.
+    """
+    path = cache.cache_path(
+        args.cache_dir, 'logs',
+        '{}-{}.log'.format(profile_name(skel.key),
+                           cache.string_key(abspath(skel.path))[:8])
+    )
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    shutil.copyfile(logf, tmp)
+    os.rename(tmp, path)
+    return path
+
+
+def cancel_run(args, cancel):
+    """
+    Set the *cancel* event so that the remaining profiles are skipped,
+    and stop the parsers of any that are running.
+    """
+    cancel.set()
+    terminate_processes()
+    if args.ace_pool is not None:
+        args.ace_pool.terminate()
+    if args.worker_pool is not None:
+        args.worker_pool.terminate()
+
+
+def run_key(skel_path, gold, args):
+    """
+    Return a digest of everything that determines the outcome of a
+    regression test: the grammar image, the skeleton and gold profile
+    contents, and the options given to ACE and art.
+    """
+    def profile_hash(path):
+        files = sorted(pjoin(path, fn) for fn in os.listdir(path)
+                       if isfile(pjoin(path, fn)))
+        return cache.hash_files(files, basedir=path)
+    return cache.hash_files([], extra=[json.dumps([
+        grammar_key(args),
+        profile_hash(skel_path),
+        profile_hash(gold),
+        args.ace_opts,
+        args.art_opts,
+        args.preprocessor
+    ])])
 
 
 def gold_path(skel_path, skel_dir, gold_dir):
@@ -83,32 +238,141 @@ def gold_path(skel_path, skel_dir, gold_dir):
     """
     return pjoin(gold_dir, relpath(abspath(skel_path), skel_dir))
 
-def skel_has_gold(skel_path, skel_dir, gold_dir):
+def skel_has_gold(skel_path, skel_dir, gold_dir, gold_index=None):
     """
     Return True if the skeleton has a corollary in the gold directory.
+    If *gold_index* (a skeletons.ProfileIndex of *gold_dir*) is given,
+    the gold directory is looked up there.
     """
-    return exists(gold_path(skel_path, skel_dir, gold_dir))
+    path = gold_path(skel_path, skel_dir, gold_dir)
+    if gold_index is not None:
+        return gold_index.has_dir(path)
+    return exists(path)
 
-def compare_mrs(dest_dir, gold_dir, log=None):
+def compare_mrs(dest_dir, gold_dir, log=None, cache_dir=None,
+                failures=None, fail_fast=False, gold_groups=None,
+                keys=None):
+    """
+    Compare the MRSs of the profile at *dest_dir* to those of the gold
+    profile at *gold_dir*, returning `True` if every item matches. If
+    *cache_dir* is given, gold MRSs are read from a sidecar file there
+    (see gtest.sidecar). If *gold_groups* is given, it is used instead
+    as the gold (parse-id, readings) pairs, as from gold_in_memory()
+    with the same *cache_dir*.
+    If *keys* is given, only those parse-ids are compared (e.g. for the
+    items selected with --items; art numbers parses by i-id). If
+    *failures* is a list, the parse-ids of mismatching items are
+    appended to it. If *fail_fast* is `True`, the comparison stops at
+    the first mismatching item.
+    """
     debug('Comparing output ({}) to gold ({})'.format(dest_dir, gold_dir), log)
-    test_profile = itsdb.ItsdbProfile(dest_dir)
-    gold_profile = itsdb.ItsdbProfile(gold_dir)
-    matched_rows = itsdb.match_rows(
-        test_profile.read_table('result'),
-        gold_profile.read_table('result'),
-        'parse-id'
-    )
+    # gold Xmrs are only rebuilt from the sidecar for readings that
+    # are not settled by their fingerprints
+    load_gold = None if cache_dir is None else load_state
+    if gold_groups is None and cache_dir is not None:
+        sidecar = GoldSidecar.load(gold_dir, cache_dir)
+        if keys is not None:
+            gold_groups = sidecar.select(keys)
+        else:
+            gold_groups = sidecar.readings()
+    else:
+        if gold_groups is None:
+            gold_groups = result_readings(gold_dir)
+        if keys is not None:
+            gold_groups = (grp for grp in gold_groups if grp[0] in keys)
+    matched_rows = tsdb.merge_join(result_readings(dest_dir), gold_groups)
     success = True
-    for (key, testrows, goldrows) in matched_rows:
-        (test_unique, shared, gold_unique) = compare_bags(
-            [simplemrs.loads_one(row['mrs']) for row in testrows],
-            [simplemrs.loads_one(row['mrs']) for row in goldrows]
+    for (key, test_readings, gold_readings) in matched_rows:
+        (test_unique, shared, gold_unique) = compare_readings(
+            test_readings, gold_readings, load_gold=load_gold
         )
-        if test_unique or gold_unique:
-            success = False
         info('{}\t<{},{},{}>'.format(key, test_unique, shared, gold_unique),
               log)
+        if test_unique or gold_unique:
+            success = False
+            if failures is not None:
+                failures.append(key)
+            if fail_fast:
+                info('Stopping at first mismatch.', log)
+                break
     debug('Completed comparison. Test {}.'
           .format('succeeded' if success else 'failed'),
           log)
     return success
+
+
+def compare_readings(test_readings, gold_readings, load_gold=None):
+    """
+    Compare two lists of (fingerprint, mrs) readings, returning a triple
+    of (unique in test, shared, unique in gold) counts. Readings with
+    equal fingerprints are shared (see match_fingerprints()); only the
+    rest are compared with compare_bags(). If *load_gold* is given, it
+    is called to get the Xmrs for a gold reading's *mrs* value.
+    """
+    if load_gold is not None:
+        loaded = {}
+
+        def gold_mrs(m):
+            if id(m) not in loaded:
+                loaded[id(m)] = load_gold(m)
+            return loaded[id(m)]
+    else:
+        gold_mrs = lambda m: m
+    shared, test_rest, gold_rest = match_fingerprints(
+        test_readings, gold_readings,
+        same=lambda t, g: isomorphic(t, gold_mrs(g))
+    )
+    if not (test_rest or gold_rest):
+        return (0, shared, 0)
+    (test_unique, bag_shared, gold_unique) = compare_bags(
+        [test_readings[i][1] for i in test_rest],
+        [gold_mrs(gold_readings[i][1]) for i in gold_rest]
+    )
+    return (test_unique, shared + bag_shared, gold_unique)
+
+
+# gold readings kept in memory in watch mode; see gold_in_memory()
+_gold_memory = {}
+_gold_memory_lock = threading.Lock()
+
+def gold_in_memory(gold_dir, cache_dir=None):
+    """
+    Return the list of (parse-id, readings) pairs of the gold profile at
+    *gold_dir*, as from GoldSidecar.readings() if *cache_dir* is given
+    and otherwise as from result_readings(), loaded on first use and
+    kept in memory until the gold result table changes.
+    """
+    source = tsdb.table_path(gold_dir, 'result')
+    st = os.stat(source)
+    stamp = (source, st.st_size, st.st_mtime)
+    with _gold_memory_lock:
+        entry = _gold_memory.get(abspath(gold_dir))
+    if entry is not None and entry[0] == stamp:
+        return entry[1]
+    if cache_dir is not None:
+        groups = list(GoldSidecar.load(gold_dir, cache_dir).readings())
+    else:
+        groups = list(result_readings(gold_dir))
+    with _gold_memory_lock:
+        _gold_memory[abspath(gold_dir)] = (stamp, groups)
+    return groups
+
+
+def result_readings(prof_path):
+    """
+    Yield (parse-id, readings) pairs from the result table of the
+    profile at *prof_path*, sorted by parse-id, where *readings* is a
+    list of (fingerprint, mrs) pairs for the parse-id's MRSs.
+    """
+    for key, rows in tsdb.group_rows(result_mrs(prof_path)):
+        mrss = [simplemrs.loads_one(mrs) for _, mrs in rows]
+        yield key, [(mrs_fingerprint(m), m) for m in mrss]
+
+
+def result_mrs(prof_path):
+    """
+    Yield (parse-id, mrs) pairs from the result table of the profile at
+    *prof_path*, sorted by parse-id.
+    """
+    return tsdb.sorted_rows(prof_path, 'result', 'parse-id',
+                            ['parse-id', 'mrs'])
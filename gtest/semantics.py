@@ -1,92 +1,172 @@
 
-import re
+import multiprocessing
 from functools import partial
-from os.path import (join as pjoin, basename, normpath, sep)
+from os.path import join as pjoin
 from subprocess import CalledProcessError
 
-from delphin import itsdb
+from delphin.__about__ import __version__ as delphin_version
 from delphin.mrs import simplemrs, path as mp
 from delphin._exceptions import XmrsError
 
+from gtest import (cache, timing, tsdb)
+from gtest.exceptions import ProfileTimeout
+
 from gtest.util import (
     prepare_working_directory, prepare_compiled_grammar,
     debug, info, warning, error, red, green, yellow,
-    check_exist, make_keypath, dir_is_profile,
-    mkprof, run_art
+    check_exist, make_keypath, dir_is_profile, profile_name, run_jobs,
+    parse_profile, finish_profile
 )
 
+from gtest.engine import (prepare_engine, close_engine)
+from gtest.history import profile_cost
+from gtest.watch import watch
+from gtest.items import select_items
 from gtest.skeletons import (
     find_profiles, prepare_profile_keypaths,
-    print_profile_header
+    print_profile_header, profile_stats, profile_context, ProfileStats
 )
 
+# number of results checked per task when using a process pool
+BATCH_SIZE = 200
+
+# faults that are not remembered by the memo (so they are logged again)
+UNMEMOIZED_FAULTS = ('no-mrs', 'error')
+
 def run(args):
     args.skel_dir = make_keypath(args.skel_dir, args.grammar_dir)
 
-    profile_match = partial(dir_is_profile, skeleton=True)
-    prepare_profile_keypaths(args, args.skel_dir.path, profile_match)
+    prepare_profile_keypaths(args, args.skel_dir.path, None)
 
     if args.list_profiles:
         print('\n'.join(map(lambda p: '{}\t{}'.format(p.key, p.path),
                             args.profiles)))
     else:
-        prepare(args)  # note: args may change
-        semantics_test(args)
+        # one process pool for the whole run, including reruns with
+        # --watch; see process_pool()
+        args.check_pool = process_pool(args.jobs) if args.jobs > 1 else None
+        try:
+            prepare(args)  # note: args may change
+            semantics_test(args)
+            if args.watch:
+                watch(args, semantics_test)
+        finally:
+            close_engine(args)
+            if args.check_pool is not None:
+                args.check_pool.terminate()
+                args.check_pool.join()
+
+
+def process_pool(processes):
+    """
+    Return a multiprocessing.Pool of *processes* worker processes.
+    gTest runs threads (e.g. the compressor and the watchdog), and
+    forking a process with threads may deadlock on locks they hold, so
+    workers are started by a fork server where available.
+    """
+    try:
+        context = multiprocessing.get_context('forkserver')
+    except (AttributeError, ValueError):  # Python 2, or not POSIX
+        context = multiprocessing
+    return context.Pool(processes)
 
 
 def prepare(args):
     prepare_working_directory(args)
     with open(pjoin(args.working_dir, 'ace.log'), 'w') as ace_log:
         prepare_compiled_grammar(args, ace_log=ace_log)
+    prepare_engine(args)
+    select_items(args)
 
 
 def semantics_test(args):
-    for skel in args.profiles:
-        name = skel.key
-        logf = pjoin(
-            args.working_dir,
-            'run-{}.log'.format(
-                '_'.join(normpath(re.sub(r'^:', '', name)).split(sep))
-            )
-        )
-
-        print_profile_header(name, skel.path)
-
-        with open(logf, 'w') as logfile:
-            try:
-                res = test_semantics(skel, args, logfile)
-                print_result_summary(name, res)
-            except CalledProcessError:
+    pool = getattr(args, 'check_pool', None)
+    memo = open_memo(args)
+    test = partial(semantics_job, args=args, pool=pool, memo=memo)
+    results = run_jobs(test, args.profiles, jobs=args.jobs,
+                       cost=profile_cost(args))
+    try:
+        for skel, (logf, res) in zip(args.profiles, results):
+            name = skel.key
+
+            print_profile_header(name, skel.path)
+
+            if logf is None:
+                print('  Skeleton was not found: {}'.format(skel.path))
+            elif res is None:
                 print('  There was an error processing the testsuite.')
                 print('  See {}'.format(logf))
+            elif isinstance(res, ProfileTimeout):
+                print('  {}: {}'.format(yellow('Timeout'), res))
+                print('  See {}'.format(logf))
+            else:
+                print_result_summary(name, res)
+    finally:
+        memo.close()
+
+
+def open_memo(args):
+    """
+    Return the memo of MRS check results shared by all profiles in the
+    run, persisted in the cache directory if `args.persist_checks` is
+    set (and the cache is not disabled).
+    """
+    path = None
+    if args.persist_checks and not args.no_cache:
+        path = cache.cache_path(args.cache_dir, 'semantics.sqlite')
+    return cache.Memo(path, max_entries=args.memo_size)
 
 
-def test_semantics(skel, args, logfile):
+def semantics_job(skel, args, pool=None, memo=None):
+    """
+    Run the semantic test for a single skeleton. Return a pair of the
+    log file path (or `None` if the skeleton was not found) and the
+    results (or `None` if processing failed, or the ProfileTimeout if
+    parsing exceeded its time limit).
+    """
+    if not check_exist(skel.path):
+        return None, None
+    logf = pjoin(args.working_dir,
+                 'run-{}.log'.format(profile_name(skel.key)))
+    res = None
+    with open(logf, 'w') as logfile, profile_context(skel):
+        try:
+            res = test_semantics(skel, args, logfile, pool=pool, memo=memo)
+        except CalledProcessError:
+            pass
+        except ProfileTimeout as ex:
+            res = ex
+    return logf, res
+
+
+def test_semantics(skel, args, logfile, pool=None, memo=None):
     info('Semantic testing profile: {}'.format(skel.key))
 
     res = {}
-    dest = pjoin(args.working_dir, basename(skel.path))
-
-    if not (check_exist(skel.path)):
-        print('  Skeleton was not found: {}'.format(skel.path))
-        return
-
-    mkprof(skel.path, dest, log=logfile)
-    run_art(
-        args.compiled_grammar.path,
-        dest,
-        options=args.art_opts,
-        ace_preprocessor=args.preprocessor,
-        ace_options=args.ace_opts,
-        log=logfile
-    )
+    dest = pjoin(args.working_dir, profile_name(skel.key))
+    stats = profile_stats(skel.path)
+
+    parse_profile(skel.path, dest, args, log=logfile)
 
-    res = semantic_test_result(dest)
+    with timing.phase('semantics'):
+        res = semantic_test_result(dest, stats=stats, pool=pool, memo=memo)
+    finish_profile(dest, args)
 
     return res
 
-def semantic_test_result(prof_path):
-    # todo: consider i-wf
+def semantic_test_result(prof_path, stats=None, pool=None, memo=None):
+    """
+    Check the MRS of each result in the profile at *prof_path* and
+    return the counts of each kind of fault. As for parsing coverage,
+    results of items whose i-wf (taken from *stats*, the ProfileStats
+    of the profile's skeleton) is neither 0 nor 1 are ignored. If
+    *pool* (a multiprocessing.Pool) is given, batches of results are
+    checked in its worker processes; the results are still counted and logged in
+    order. If *memo* (a gtest.cache.Memo) is given, MRSs it has seen
+    before are not checked again.
+    """
+    if stats is None:
+        stats = ProfileStats(prof_path)
     res =dict([
         ('i-ids', set()),
         ('result', 0), #
@@ -99,43 +179,114 @@ def semantic_test_result(prof_path):
         # ('scope', 0), # MRSs that scope well
         # ('headed', 0) # fully headed MRSs (can be tree-ified)
     ])
-    prof = itsdb.ItsdbProfile(prof_path, index=False)
-
-    for row in prof.join('parse', 'result'):
-        iid, rid = row['parse:i-id'], row['result:result-id']
-        mrs = row['result:mrs']
-
-        res['i-ids'].add(iid)
-        res['result'] += 1
-
-        faults = []
-        if mrs:
-            try:
-                m = simplemrs.loads_one(mrs)
-                if not m.is_well_formed():
-                    faults.append('ill-formed')
-                if not m.is_connected():
-                    faults.append('disconnected')
-                headed_nids = [n for _, n, _ in mp.walk(m) if n != 0]
-                if set(headed_nids) != set(m.nodeids()):
-                    faults.append('non-headed')
-            except XmrsError:
-                faults.append('bad-mrs')
-            except:
-                faults.append('error')
-        else:
-            faults.append('no-mrs')
-        if faults:
-            info('{iid}-{rid}\t{faults}'
-                 .format(iid=iid, rid=rid, faults=' '.join(faults)))
-            if 'error' in faults:
-                debug(mrs)
-            for fault in faults:
-                res[fault] += 1
-        else:
-            debug('{iid}-{rid}'.format(iid=iid, rid=rid))
+    wfs = stats.wf
+    rows = ((iid, rid, mrs) for iid, rid, mrs in result_rows(prof_path)
+            if wfs.get(int(iid)) in (0, 1))
+    if memo is not None:
+        rows = ((iid, rid, mrs, memo.get(memo_key(mrs)))
+                for iid, rid, mrs in rows)
+    else:
+        rows = ((iid, rid, mrs, None) for iid, rid, mrs in rows)
+    batches = _batches(rows, BATCH_SIZE)
+    if pool is not None:
+        checked = pool.imap(check_rows, batches)
+    else:
+        checked = (check_rows(batch) for batch in batches)
+
+    for batch in checked:
+        for iid, rid, mrs, faults, fresh in batch:
+            if fresh and memo is not None and mrs and not any(
+                    f in UNMEMOIZED_FAULTS for f in faults):
+                memo.put(memo_key(mrs), faults)
+            res['i-ids'].add(iid)
+            res['result'] += 1
+            if faults:
+                info('{iid}-{rid}\t{faults}'
+                     .format(iid=iid, rid=rid, faults=' '.join(faults)))
+                if 'error' in faults:
+                    debug(mrs)
+                for fault in faults:
+                    res[fault] += 1
+            else:
+                debug('{iid}-{rid}'.format(iid=iid, rid=rid))
     return res
 
+
+def result_rows(prof_path):
+    """
+    Yield (i-id, result-id, mrs) for each result in the profile at
+    *prof_path*, joining the parse and result tables on parse-id as
+    sorted streams.
+    """
+    parses = tsdb.group_rows(
+        tsdb.sorted_rows(prof_path, 'parse', 'parse-id', ['parse-id', 'i-id'])
+    )
+    results = tsdb.group_rows(
+        tsdb.sorted_rows(prof_path, 'result', 'parse-id',
+                         ['parse-id', 'result-id', 'mrs'])
+    )
+    for _, parse_group, result_group in tsdb.merge_join(parses, results):
+        for _, iid in parse_group:
+            for _, rid, mrs in result_group:
+                yield iid, rid, mrs
+
+
+def check_rows(rows):
+    """
+    Return a list of (i-id, result-id, mrs, faults, checked) for each
+    (i-id, result-id, mrs, known) tuple in *rows*, where the MRS is
+    only checked if its *known* faults are `None`. This is the unit of
+    work sent to the process pool in semantic_test_result().
+    """
+    return [
+        (iid, rid, mrs, mrs_faults(mrs), True) if known is None
+        else (iid, rid, mrs, known, False)
+        for iid, rid, mrs, known in rows
+    ]
+
+
+def memo_key(mrs):
+    """
+    Return the memo key for the SimpleMRS string *mrs*. The pyDelphin
+    version is included since the checks are done by pyDelphin.
+    """
+    return cache.string_key(delphin_version + '\0' + mrs)
+
+
+def mrs_faults(mrs):
+    """
+    Return the list of faults found in the SimpleMRS string *mrs*.
+    """
+    faults = []
+    if mrs:
+        try:
+            m = simplemrs.loads_one(mrs)
+            if not m.is_well_formed():
+                faults.append('ill-formed')
+            if not m.is_connected():
+                faults.append('disconnected')
+            headed_nids = [n for _, n, _ in mp.walk(m) if n != 0]
+            if set(headed_nids) != set(m.nodeids()):
+                faults.append('non-headed')
+        except XmrsError:
+            faults.append('bad-mrs')
+        except:
+            faults.append('error')
+    else:
+        faults.append('no-mrs')
+    return faults
+
+
+def _batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
 template1 = '  {:12s}: {:5d}/{:<5d} ({: >6.4f}{})'
 template2 = '  {:12s}: {:5d}/{:<5d} ({: >6.2%}{})'
 
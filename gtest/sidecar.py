@@ -0,0 +1,178 @@
+"""
+Pre-deserialized gold MRSs.
+
+Gold profiles rarely change, but parsing their MRS strings with
+simplemrs is a large share of a regression run. A sidecar file in the
+cache directory stores the MRSs of a gold profile's result table in a
+pickled form that is much faster to load, indexed by parse-id. It is
+rebuilt whenever the result table's size and modification time change
+and its content hash no longer matches.
+
+File layout: a pickled header, one pickled (parse-id, readings) record
+per parse-id in sorted order (each reading is a pair of the MRS
+fingerprint, see gtest.fingerprint, and the separately pickled MRS
+state, so readings settled by their fingerprints are never
+unpickled; see load_state()), a pickled
+index mapping parse-ids to record offsets, and finally the 8-byte
+offset of the index.
+"""
+
+import os
+import struct
+import hashlib
+from os.path import (abspath, join as pjoin, exists, getsize, getmtime)
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from gtest import (cache, tsdb)
+from gtest.fingerprint import mrs_fingerprint
+
+from delphin.mrs import simplemrs
+from delphin.mrs.xmrs import Xmrs
+
+
+SIDECAR_VERSION = 5
+_footer = struct.Struct('<Q')
+
+
+def xmrs_state(m):
+    """
+    Return a picklable tuple from which xmrs_from_state() rebuilds the
+    Xmrs *m*.
+    """
+    return (
+        m.top, m.index, m.xarg,
+        [tuple(ep) for ep in m.eps()],
+        [tuple(hc) for hc in m.hcons()],
+        [tuple(ic) for ic in m.icons()],
+        dict((v, m.properties(v, as_list=True)) for v in m.variables()),
+        m.lnk, m.surface, m.identifier
+    )
+
+
+def load_state(data):
+    """
+    Return the Xmrs of a reading's pickled state *data*.
+    """
+    return xmrs_from_state(pickle.loads(data))
+
+
+def xmrs_from_state(state):
+    top, index, xarg, eps, hcons, icons, vars, lnk, surface, ident = state
+    return Xmrs(top=top, index=index, xarg=xarg, eps=eps, hcons=hcons,
+                icons=icons, vars=vars, lnk=lnk, surface=surface,
+                identifier=ident)
+
+
+class GoldSidecar(object):
+    """
+    Read access to the sidecar file at *path*. Use GoldSidecar.load()
+    to get an up-to-date sidecar for a gold profile.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._index = None
+
+    @classmethod
+    def load(cls, gold_dir, cache_dir):
+        """
+        Return the sidecar for the gold profile at *gold_dir*, building
+        it under *cache_dir* first if it is missing or out of date.
+        """
+        key = hashlib.sha1(abspath(gold_dir).encode('utf-8')).hexdigest()
+        path = cache.cache_path(cache_dir, 'gold', key + '.pickle')
+        source = tsdb.table_path(gold_dir, 'result')
+        with cache.file_lock(path + '.lock'):
+            if not _is_valid(path, source):
+                build_sidecar(gold_dir, path)
+        return cls(path)
+
+    def readings(self):
+        """
+        Yield (parse-id, readings) pairs for every parse-id in order,
+        where *readings* is a list of (fingerprint, data) pairs; the
+        Xmrs for a reading's data is built with load_state().
+        """
+        with open(self.path, 'rb') as f:
+            pickle.load(f)  # header
+            end = self._index_offset(f)
+            while f.tell() < end:
+                yield pickle.load(f)
+
+    def select(self, keys):
+        """
+        Yield (parse-id, readings) pairs, as from readings(), for the
+        parse-ids in *keys* that have results, in order, reading only
+        their records (through the index).
+        """
+        with open(self.path, 'rb') as f:
+            if self._index is None:
+                f.seek(self._index_offset(f))
+                self._index = pickle.load(f)
+            for key in sorted(k for k in keys if k in self._index):
+                f.seek(self._index[key])
+                yield pickle.load(f)
+
+    def _index_offset(self, f):
+        pos = f.tell()
+        f.seek(-_footer.size, os.SEEK_END)
+        offset = _footer.unpack(f.read(_footer.size))[0]
+        f.seek(pos)
+        return offset
+
+
+def build_sidecar(gold_dir, path):
+    """
+    Write the sidecar file for the gold profile at *gold_dir* to *path*.
+    """
+    source = tsdb.table_path(gold_dir, 'result')
+    header = {
+        'version': SIDECAR_VERSION,
+        'size': getsize(source),
+        'mtime': getmtime(source),
+        'sha1': cache.hash_files([source], basedir=gold_dir)
+    }
+    index = {}
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        pickle.dump(header, f, pickle.HIGHEST_PROTOCOL)
+        rows = tsdb.sorted_rows(gold_dir, 'result', 'parse-id',
+                                ['parse-id', 'mrs'])
+        for key, group in tsdb.group_rows(rows):
+            index[key] = f.tell()
+            mrss = [simplemrs.loads_one(mrs) for _, mrs in group]
+            readings = [
+                (mrs_fingerprint(m),
+                 pickle.dumps(xmrs_state(m), pickle.HIGHEST_PROTOCOL))
+                for m in mrss
+            ]
+            pickle.dump((key, readings), f, pickle.HIGHEST_PROTOCOL)
+        offset = f.tell()
+        pickle.dump(index, f, pickle.HIGHEST_PROTOCOL)
+        f.write(_footer.pack(offset))
+    os.rename(tmp, path)
+
+
+def _is_valid(path, source):
+    if not exists(path):
+        return False
+    try:
+        with open(path, 'rb') as f:
+            header = pickle.load(f)
+    except (IOError, OSError, EOFError, pickle.UnpicklingError):
+        return False
+    if header.get('version') != SIDECAR_VERSION:
+        return False
+    size = getsize(source)
+    if header['size'] != size:
+        return False
+    if header['mtime'] == getmtime(source):
+        return True
+    # touched but maybe not changed (e.g. by a version control checkout)
+    return header['sha1'] == cache.hash_files(
+        [source], basedir=os.path.dirname(source)
+    )
@@ -1,47 +1,306 @@
-
 import os
-from os.path import exists
-from glob import glob
+import stat
+import fnmatch
+import threading
+from array import array
+from os.path import exists, abspath, relpath, join as pjoin, sep
+from glob import glob, has_magic
+
+try:
+    from os import scandir
+except ImportError:
+    scandir = None
 
 from gtest.util import (
     debug, info, warning, error,
     dir_is_profile, make_keypath, resolve_profile_key
 )
 
-from delphin import itsdb
+from gtest import (cache, timing, tsdb)
 
 # Methods related to tests that read [incr tsdb()] skeletons
 
-def find_profiles(basedir, profile_match, skeleton=True):
-    profs = []
-    for (dirpath, dirnames, filenames) in os.walk(basedir):
-        if not dir_is_profile(dirpath, skeleton=skeleton):
-            continue
-        if profile_match(dirpath):
-            profs.append(dirpath)
-        dirnames.sort()  # this affects traversal order
-    return profs
+def find_profiles(basedir, profile_match, skeleton=True, index=None):
+    if index is None:
+        index = ProfileIndex(basedir)
+        index.refresh()
+    return [path for path in index.profiles(skeleton=skeleton)
+            if profile_match is None or profile_match(path)]
+
+
+SKELETON_FILES = ('item', 'relations')
+PROFILE_FILES = ('item', 'relations', 'parse', 'result')
+
+
+class ProfileIndex(object):
+    """
+    An index of the directories under *basedir* recording which are
+    skeletons or full profiles, in the sense of util.dir_is_profile().
+
+    refresh() brings the index up to date by stat-ing each directory
+    and the profile files (e.g. `item`) found in it, and only listing
+    (with os.scandir) those directories where a modification time
+    changed since they were last indexed: a directory's own modification
+    time changes when entries are added, removed, or renamed, but not
+    when a file in it is rewritten in place.
+
+    Symlinked subdirectories are listed but not indexed, so they are
+    not found by profiles() (as with os.walk()), and paths under them
+    are checked on the filesystem.
+    """
+
+    def __init__(self, basedir, entries=None):
+        self.root = basedir  # as given, for the paths returned
+        self.basedir = abspath(basedir)
+        # relative path -> [mtime, is skeleton, is profile, subdirs,
+        #                   symlinked subdirs (not indexed),
+        #                   profile file names -> mtimes]
+        self.entries = dict(entries or {})
+        self.changed = False
+
+    def refresh(self):
+        """
+        Re-index the directories that changed. Return `True` if
+        anything changed.
+        """
+        self.changed = False
+        entries = {}
+        todo = ['.']
+        while todo:
+            rel = todo.pop()
+            try:
+                mtime = os.stat(pjoin(self.basedir, rel)).st_mtime
+            except OSError:
+                continue
+            entry = self.entries.get(rel)
+            if entry is None or entry[0] != mtime or _files_changed(
+                    pjoin(self.basedir, rel), entry):
+                entry = [mtime] + list(_scan_dir(pjoin(self.basedir, rel)))
+                entry[3] = [os.path.normpath(pjoin(rel, d))
+                            for d in entry[3]]
+                self.changed = True
+            entries[rel] = entry
+            todo.extend(entry[3])
+        if set(entries) != set(self.entries):
+            self.changed = True
+        self.entries = entries
+        return self.changed
+
+    def profiles(self, skeleton=True):
+        """
+        Return the paths of all (skeleton) profiles in sorted
+        traversal order.
+        """
+        flag = 1 if skeleton else 2
+        return [self._path(rel) for rel in self._walk()
+                if self.entries[rel][flag]]
+
+    def _path(self, rel):
+        return self.root if rel == '.' else pjoin(self.root, rel)
+
+    def _walk(self):
+        todo = ['.']
+        while todo:
+            rel = todo.pop()
+            yield rel
+            todo.extend(sorted(self.entries[rel][3], reverse=True))
+
+    def relative_path(self, path):
+        """
+        Return *path* relative to the base directory, or `None` if it
+        is not under it.
+        """
+        rel = relpath(abspath(path), self.basedir)
+        if rel == os.pardir or rel.startswith(os.pardir + sep):
+            return None
+        return rel
+
+    def has_dir(self, path):
+        """
+        Return `True` if *path* is an indexed directory. Paths outside
+        the base directory or under a symlinked directory are checked
+        on the filesystem.
+        """
+        rel = self.relative_path(path)
+        if rel is None or self._under_link(rel):
+            return os.path.isdir(path)
+        return rel in self.entries
+
+    def _under_link(self, rel):
+        # True if rel is, or is under, a symlinked (unindexed) directory
+        parent = '.'
+        for name in rel.split(sep):
+            entry = self.entries.get(parent)
+            if entry is None:
+                return False
+            if name in entry[4]:
+                return True
+            parent = os.path.normpath(pjoin(parent, name))
+        return False
+
+    def is_profile(self, path, skeleton=False):
+        """
+        Like util.dir_is_profile(), but looked up in the index where
+        possible.
+        """
+        rel = self.relative_path(path)
+        entry = None if rel is None else self.entries.get(rel)
+        if entry is None:
+            # outside the base directory, under a symlink, or missing
+            return dir_is_profile(path, skeleton=skeleton)
+        return bool(entry[1 if skeleton else 2])
+
+    def glob(self, pattern):
+        """
+        Return the sorted indexed directories matching the glob
+        *pattern*, which must be under the base directory. As with
+        glob.glob(), symlinked directories match too, and the rest of
+        the pattern is matched on the filesystem under them.
+        """
+        rel = self.relative_path(pattern)
+        parts = os.path.normpath(rel).split(sep)
+        matches = []
+        for path in self._walk():
+            links = [os.path.normpath(pjoin(path, name))
+                     for name in self.entries[path][4]]
+            for candidate in ([] if path == '.' else [path]) + links:
+                components = candidate.split(sep)
+                n = len(components)
+                if n > len(parts) or not all(
+                        fnmatch.fnmatchcase(c, p)
+                        for c, p in zip(components, parts)):
+                    continue
+                if n == len(parts):
+                    matches.append(self._path(candidate))
+                elif candidate in links:
+                    matches.extend(glob(pjoin(self._path(candidate),
+                                              *parts[n:])))
+        return sorted(matches)
+
+
+def _scan_dir(path):
+    """
+    Return (is skeleton, is profile, subdirectory names, symlinked
+    subdirectory names, profile file names -> mtimes) for the directory
+    at *path*.
+    """
+    sizes = {}
+    mtimes = {}
+    subdirs = []
+    links = []
+    if scandir is not None:
+        for entry in scandir(path):
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.name)
+                elif entry.is_dir():
+                    links.append(entry.name)
+                elif tsdb.table_name(entry.name) in PROFILE_FILES:
+                    st = entry.stat()
+                    _add_size(sizes, entry.name, st.st_size)
+                    mtimes[entry.name] = st.st_mtime
+            except OSError:
+                pass
+    else:
+        for name in os.listdir(path):
+            try:
+                st = os.stat(pjoin(path, name))
+            except OSError:
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                if os.path.islink(pjoin(path, name)):
+                    links.append(name)
+                else:
+                    subdirs.append(name)
+            elif tsdb.table_name(name) in PROFILE_FILES:
+                _add_size(sizes, name, st.st_size)
+                mtimes[name] = st.st_mtime
+    is_skel = all(sizes.get(fn, 0) > 0 for fn in SKELETON_FILES)
+    is_prof = all(sizes.get(fn, 0) > 0 for fn in PROFILE_FILES)
+    return is_skel, is_prof, subdirs, links, mtimes
+
+
+def _files_changed(path, entry):
+    """
+    Return `True` if any profile file recorded in the index *entry* for
+    the directory at *path* was modified (or is gone), or if *entry*
+    is from an older index without them.
+    """
+    if len(entry) < 6:
+        return True
+    for name, mtime in entry[5].items():
+        try:
+            if os.stat(pjoin(path, name)).st_mtime != mtime:
+                return True
+        except OSError:
+            return True
+    return False
+
+
+def _add_size(sizes, fn, size):
+    # a plain table is used rather than a gzipped one if both exist
+    table = tsdb.table_name(fn)
+    if table == fn or table not in sizes:
+        sizes[table] = size
+
+
+_indices = {}
+_indices_lock = threading.Lock()
+
+def profile_index(basedir, args=None):
+    """
+    Return the up-to-date ProfileIndex of *basedir*, refreshed once per
+    run. Unless caching is disabled, indices are kept in the cache
+    directory given by *args* between runs.
+    """
+    basedir = abspath(basedir)
+    with _indices_lock:
+        index = _indices.get(basedir)
+        if index is not None:
+            return index
+        path = None
+        if args is not None and not args.no_cache:
+            path = cache.cache_path(args.cache_dir, 'profiles.json')
+            stored = cache.load_json(path).get(basedir)
+            index = ProfileIndex(basedir, stored)
+        else:
+            index = ProfileIndex(basedir)
+        if index.refresh() and path is not None:
+            cache.update_json(path, {basedir: index.entries})
+        _indices[basedir] = index
+        return index
 
 
 def prepare_profile_keypaths(args, basedir, profile_match, skeleton=True):
+    """
+    Set `args.profiles` to the KeyPaths of the profiles given in
+    `args.profiles`, or of all profiles under *basedir* if none are
+    given. If *profile_match* is not `None`, only profiles for which it
+    returns `True` are used.
+    """
     profs = []
+    index = profile_index(basedir, args)
 
     if not args.profiles:
         profs = [
             make_keypath(p, basedir)
-            for p in find_profiles(basedir, profile_match, skeleton=skeleton)
+            for p in find_profiles(basedir, profile_match,
+                                   skeleton=skeleton, index=index)
         ]
 
     else:
         for k in args.profiles:
             p = resolve_profile_key(k, basedir)
-            paths = glob(p)
+            if has_magic(p) and index.relative_path(p) is not None:
+                paths = index.glob(p)
+            else:
+                paths = glob(p)
             _profs = []
-            for path in glob(p):
+            for path in paths:
                 if exists(path):
-                    if not dir_is_profile(path, skeleton=True):
+                    if not index.is_profile(path, skeleton=True):
                         debug('Found path is not a skeleton: {}'.format(path))
-                    elif profile_match(path):
+                    elif profile_match is None or profile_match(path):
                         _profs.append(make_keypath(path, basedir))
                     else:
                         debug('Profile found by "{}" not valid for the '
@@ -57,26 +316,89 @@ def prepare_profile_keypaths(args, basedir, profile_match, skeleton=True):
     args.profiles = profs
 
 def print_profile_header(name, skel):
-    prof = itsdb.ItsdbProfile(skel, index=False)
-    wf0_items = 0
-    wf1_items = 0
-    wf2_items = 0
-    for i, row in enumerate(prof.read_table('item')):
-        try:
-            wf = int(row['i-wf'])
-        except ValueError:
-            wf = -1
-        if wf == 0:
-            wf0_items += 1
-        elif wf == 1:
-            wf1_items += 1
-        elif wf == 2:
-            wf2_items += 1
-        else:
-            warning(
-                'Invalid i-wf value ({}) in line {} of {}'
-                .format(row['i-wf'], i + 1, skel)
-            )
+    stats = profile_stats(skel)
+    wf_counts = stats.wf_counts
     print('{} ({} items; {} ignored):'.format(
-        name, wf0_items + wf1_items + wf2_items, wf2_items
+        name, wf_counts[0] + wf_counts[1] + wf_counts[2], wf_counts[2]
     ))
+
+
+class ProfileStats(object):
+    """
+    Statistics over the `item` table of a profile, gathered in a single
+    pass. Use profile_stats() to get them for a skeleton.
+
+    Attributes:
+        items: the number of items
+        wf_counts: number of items for each i-wf value (0, 1, 2, and -1
+            for invalid values)
+        wf: mapping of i-id to i-wf (a tsdb.IntMap)
+        lengths: mapping of i-id to i-length (-1 if unset; a tsdb.IntMap)
+    """
+
+    def __init__(self, prof_path):
+        self.wf_counts = {0: 0, 1: 0, 2: 0, -1: 0}
+        iids = array('l')
+        wfs = array('b')
+        lengths = array('l')
+        rows = tsdb.iter_rows(prof_path, 'item', ['i-id', 'i-wf', 'i-length'])
+        for i, (iid, raw_wf, length) in enumerate(rows):
+            iid = int(iid)
+            try:
+                wf = int(raw_wf)
+            except ValueError:
+                wf = -1
+            if wf not in (0, 1, 2):
+                wf = -1
+                warning(
+                    'Invalid i-wf value ({}) in line {} of {}'
+                    .format(raw_wf, i + 1, prof_path)
+                )
+            self.wf_counts[wf] += 1
+            iids.append(iid)
+            wfs.append(wf)
+            try:
+                lengths.append(int(length))
+            except ValueError:
+                lengths.append(-1)
+        self.items = len(iids)
+        if tsdb.is_sorted(iids):
+            tsdb.mark_sorted(prof_path, 'item', 'i-id')
+        self.wf = tsdb.IntMap(iids, wfs)
+        self.lengths = tsdb.IntMap(iids, lengths)
+
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+def profile_stats(skel):
+    """
+    Return the ProfileStats for the skeleton at *skel*. They are computed
+    once per run and shared by everything that needs them.
+    """
+    path = abspath(skel)
+    with _stats_lock:
+        stats = _stats.get(path)
+    if stats is None:
+        stats = ProfileStats(path)
+        with _stats_lock:
+            stats = _stats.setdefault(path, stats)
+    return stats
+
+
+def forget_profile_stats(skel):
+    """
+    Discard the ProfileStats of the skeleton at *skel* (e.g. when it
+    has changed), so they are computed again when next needed.
+    """
+    with _stats_lock:
+        _stats.pop(abspath(skel), None)
+
+
+def profile_context(skel):
+    """
+    Return a gtest.timing context for testing the skeleton KeyPath
+    *skel*.
+    """
+    return timing.context(profile=skel.key,
+                          items=profile_stats(skel.path).items)
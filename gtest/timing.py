@@ -0,0 +1,156 @@
+"""
+Timing records for the phases of a test run.
+
+When enabled with start(), every phase() writes one JSON object per
+line to the timings file with its wall-clock time, the CPU time of the
+thread running it, and the CPU time and peak memory (RSS) of the
+subprocesses it ran, along with fields from the enclosing context()
+(e.g. the profile key and number of items).
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # not on POSIX
+    resource = None
+
+
+_writer = None
+_local = threading.local()
+
+if hasattr(time, 'thread_time'):
+    _thread_cpu = time.thread_time
+else:
+    # only per-process CPU time is available, which overcounts with -j
+    _thread_cpu = lambda: sum(os.times()[:2])
+
+# ru_maxrss is in kilobytes, except on macOS where it is in bytes
+_RSS_DIVISOR = 1024 if sys.platform == 'darwin' else 1
+
+
+class _Writer(object):
+    def __init__(self, path, fields):
+        self.file = open(path, 'a')
+        self.fields = fields
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        data = dict(self.fields)
+        data.update(record)
+        line = json.dumps(data, sort_keys=True)
+        with self.lock:
+            self.file.write(line + '\n')
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def start(path, **fields):
+    """
+    Start appending timing records to the file at *path*. Every record
+    includes *fields* and `run`, the start time of the run.
+    """
+    global _writer
+    fields.setdefault('run', time.strftime('%Y-%m-%dT%H:%M:%S'))
+    _writer = _Writer(path, fields)
+
+
+def stop():
+    """
+    Stop writing timing records.
+    """
+    global _writer
+    if _writer is not None:
+        _writer.close()
+        _writer = None
+
+
+def current_context():
+    """
+    Return the fields of the current thread's context, e.g. to continue
+    it in another thread with context(**fields).
+    """
+    return dict(getattr(_local, 'context', {}))
+
+
+@contextmanager
+def context(**fields):
+    """
+    Add *fields* to the records of phases timed in this thread for the
+    duration of the context.
+    """
+    old = getattr(_local, 'context', {})
+    new = dict(old)
+    new.update(fields)
+    _local.context = new
+    try:
+        yield
+    finally:
+        _local.context = old
+
+
+@contextmanager
+def phase(name, process_children=False, **fields):
+    """
+    Time the phase *name* of the current context. The yielded dict is
+    the record to be written and may be updated in the context.
+    Subprocesses reported with child_usage() are attributed to the
+    innermost phase of their thread; if *process_children* is `True`
+    the usage of all children of the process that finished in the
+    meantime is used instead, which is only accurate when nothing else
+    runs at the same time (e.g. grammar compilation).
+    """
+    if _writer is None:
+        yield {}
+        return
+    record = current_context()
+    record.update(fields)
+    record.update(phase=name, child_cpu=None, child_maxrss_kb=None)
+    stack = getattr(_local, 'phases', None)
+    if stack is None:
+        stack = _local.phases = []
+    stack.append(record)
+    if process_children and resource is not None:
+        before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    wall, cpu = time.time(), _thread_cpu()
+    record['ok'] = False
+    try:
+        yield record
+        record['ok'] = True
+    finally:
+        record['wall'] = round(time.time() - wall, 6)
+        record['cpu'] = round(_thread_cpu() - cpu, 6)
+        stack.pop()
+        if process_children and resource is not None:
+            after = resource.getrusage(resource.RUSAGE_CHILDREN)
+            record['child_cpu'] = round(
+                (after.ru_utime + after.ru_stime)
+                - (before.ru_utime + before.ru_stime), 6
+            )
+            # only the peak over all children so far is available
+            record['child_maxrss_kb'] = after.ru_maxrss // _RSS_DIVISOR
+        _writer.write(record)
+
+
+def child_usage(usage):
+    """
+    Attribute the resource usage *usage* (as returned by os.wait4()) of
+    a finished subprocess to the innermost phase of this thread.
+    """
+    stack = getattr(_local, 'phases', None)
+    if not stack:
+        return
+    record = stack[-1]
+    record['child_cpu'] = round(
+        (record['child_cpu'] or 0) + usage.ru_utime + usage.ru_stime, 6
+    )
+    record['child_maxrss_kb'] = max(
+        record['child_maxrss_kb'] or 0, usage.ru_maxrss // _RSS_DIVISOR
+    )
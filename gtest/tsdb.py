@@ -0,0 +1,387 @@
+"""
+Streaming access to [incr tsdb()] tables.
+
+pyDelphin's ItsdbProfile reads rows as dictionaries and its join and
+match functions hold whole tables in memory. The functions here read
+only the requested columns, as tuples, and work on sorted streams so
+memory use is bounded by the largest group of rows sharing a key.
+
+Tables may be gzipped (e.g. `result.gz`); as with pyDelphin, a plain
+table is used if both exist.
+
+Sorting by a key first checks whether the table is already sorted,
+which takes an extra pass; tables known to be sorted (see
+mark_sorted()) are read once, checking the order as they go. What is
+known is kept between runs with load_order() and save_order().
+"""
+
+import os
+import gzip
+import heapq
+import bisect
+import shutil
+import tempfile
+import threading
+from io import (TextIOWrapper, BufferedReader)
+from array import array
+from os.path import (join as pjoin, exists)
+from itertools import groupby
+
+from delphin import itsdb
+
+from gtest import cache
+from gtest.exceptions import GTestError
+
+
+# number of rows held in memory per run when sorting externally
+SORT_BUFFER_SIZE = 100000
+
+
+def table_fields(prof_path, table):
+    """
+    Return the list of column names of *table* in the profile at
+    *prof_path*.
+    """
+    relations = itsdb.get_relations(pjoin(prof_path, 'relations'))
+    return [f.name for f in relations[table]]
+
+
+def table_path(prof_path, table):
+    """
+    Return the path of *table* in the profile at *prof_path*: the plain
+    file if it exists, otherwise the gzipped one if that exists, and
+    otherwise the (nonexistent) plain file.
+    """
+    path = pjoin(prof_path, table)
+    if not exists(path) and exists(path + '.gz'):
+        return path + '.gz'
+    return path
+
+
+def table_name(fn):
+    """
+    Return the name of the table stored in the file named *fn*, which
+    may be gzipped.
+    """
+    return fn[:-3] if fn.endswith('.gz') else fn
+
+
+def open_table(prof_path, table):
+    """
+    Open *table* in the profile at *prof_path* for reading as text,
+    decompressing it if it is gzipped.
+    """
+    path = table_path(prof_path, table)
+    if path.endswith('.gz'):
+        # text mode for gzip.open() is only available from Python 3.3
+        return TextIOWrapper(BufferedReader(gzip.open(path, mode='r')))
+    return open(path)
+
+
+def iter_rows(prof_path, table, columns):
+    """
+    Yield tuples of the values of *columns* for each row of *table* in
+    the profile at *prof_path*.
+    """
+    fields = table_fields(prof_path, table)
+    idx = [fields.index(col) for col in columns]
+    unescape = itsdb.unescape
+    with open_table(prof_path, table) as f:
+        for line in f:
+            cells = line.rstrip('\n').split('@')
+            yield tuple(unescape(cells[i]) for i in idx)
+
+
+def sorted_rows(prof_path, table, key, columns):
+    """
+    Yield tuples like iter_rows(), but sorted by the integer value of
+    the *key* column, which must be the first of *columns*. Tables are
+    usually already sorted (art writes them in item order): if *table*
+    is known to be sorted by *key* (see mark_sorted()), it is read once
+    and GTestError is raised if a key turns out to decrease; otherwise
+    the order is checked first (see check_sorted()) and an external
+    merge sort is used if needed.
+    """
+    assert columns[0] == key
+    rows = ((int(row[0]),) + row[1:]
+            for row in iter_rows(prof_path, table, columns))
+    if known_sorted(prof_path, table, key):
+        prev = None
+        for row in rows:
+            if prev is not None and row[0] < prev:
+                path = table_path(prof_path, table)
+                _forget(path, key)
+                raise GTestError('{} is not sorted by {}'.format(path, key))
+            prev = row[0]
+            yield row
+        return
+    if check_sorted(prof_path, table, key):
+        for row in rows:
+            yield row
+    else:
+        for row in external_sort(rows):
+            yield row
+
+
+def is_sorted(values):
+    """
+    Return `True` if *values* is in non-decreasing order.
+    """
+    prev = None
+    for val in values:
+        if prev is not None and val < prev:
+            return False
+        prev = val
+    return True
+
+
+def external_sort(rows, buffer_size=SORT_BUFFER_SIZE):
+    """
+    Yield *rows* in sorted order while holding at most *buffer_size*
+    rows in memory, by sorting runs of rows into temporary files and
+    merging them.
+    """
+    runs = []
+    while True:
+        chunk = sorted(_take(rows, buffer_size))
+        if not chunk:
+            break
+        if not runs and len(chunk) < buffer_size:
+            for row in chunk:  # everything fit in memory
+                yield row
+            return
+        f = tempfile.TemporaryFile(mode='w+')
+        for row in chunk:
+            f.write(itsdb.encode_row(row) + '\n')
+        f.seek(0)
+        runs.append(f)
+    try:
+        for row in heapq.merge(*[_read_run(f) for f in runs]):
+            yield row
+    finally:
+        for f in runs:
+            f.close()
+
+
+def _take(iterable, n):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= n:
+            break
+    return chunk
+
+
+def _read_run(f):
+    for line in f:
+        row = itsdb.decode_row(line)
+        yield (int(row[0]),) + tuple(row[1:])
+
+
+def group_rows(rows):
+    """
+    Yield pairs of (key, rows) for runs of *rows* sharing the same
+    first value.
+    """
+    for key, group in groupby(rows, key=lambda row: row[0]):
+        yield key, list(group)
+
+
+def merge_join(left, right):
+    """
+    Yield triples of (key, left_rows, right_rows) from two streams of
+    sorted (key, rows) groups, as from group_rows(). Every key in
+    either stream is yielded once; a key missing from one side gets an
+    empty list for that side.
+    """
+    left, right = iter(left), iter(right)
+    lgrp, rgrp = next(left, None), next(right, None)
+    while lgrp is not None or rgrp is not None:
+        if rgrp is None or (lgrp is not None and lgrp[0] < rgrp[0]):
+            yield (lgrp[0], lgrp[1], [])
+            lgrp = next(left, None)
+        elif lgrp is None or rgrp[0] < lgrp[0]:
+            yield (rgrp[0], [], rgrp[1])
+            rgrp = next(right, None)
+        else:
+            yield (lgrp[0], lgrp[1], rgrp[1])
+            lgrp, rgrp = next(left, None), next(right, None)
+
+
+def compress_profile(prof_path, min_size=0):
+    """
+    Replace each table of the profile at *prof_path* that is larger
+    than *min_size* bytes with a gzipped copy. The relations file and
+    tables that are hard-linked (e.g. from a skeleton) are left alone.
+    """
+    for fn in os.listdir(prof_path):
+        path = pjoin(prof_path, fn)
+        if fn == 'relations' or fn.endswith('.gz') or not os.path.isfile(path):
+            continue
+        st = os.stat(path)
+        if st.st_size <= min_size or st.st_nlink > 1:
+            continue
+        tmp = path + '.gz.tmp'
+        with open(path, 'rb') as src, gzip.open(tmp, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.rename(tmp, path + '.gz')
+        os.remove(path)
+
+
+#
+# TABLE ORDER
+#
+
+_order_path = None
+_order = {}  # 'path#key' -> [size, mtime] of tables sorted by key
+_new_order = {}
+_order_lock = threading.Lock()
+
+
+def load_order(path=None):
+    """
+    Start remembering which tables are sorted, reading what was known
+    from the JSON file at *path* (if given); see save_order().
+    """
+    global _order_path, _order, _new_order
+    with _order_lock:
+        _order_path = path
+        _order = {} if path is None else cache.load_json(path)
+        _new_order = {}
+
+
+def save_order():
+    """
+    Write which tables were found to be sorted in this run to the file
+    given to load_order() (if any).
+    """
+    with _order_lock:
+        if _order_path is not None and _new_order:
+            cache.update_json(_order_path, _new_order)
+        _new_order.clear()
+
+
+def mark_sorted(prof_path, table, key):
+    """
+    Note that *table* in the profile at *prof_path* is sorted by the
+    integer value of its *key* column, as it is when it was just
+    written in that order, so sorted_rows() need not check it first.
+    The note holds until the table file changes and, unlike what
+    check_sorted() finds, is not kept by save_order(), as such tables
+    are usually in temporary working profiles.
+    """
+    path = table_path(prof_path, table)
+    stamp = _stamp(path)
+    if stamp is not None:
+        _remember(path, key, stamp, keep=False)
+
+
+def known_sorted(prof_path, table, key):
+    """
+    Return `True` if *table* in the profile at *prof_path* is known to
+    be sorted by its *key* column (see mark_sorted()).
+    """
+    path = table_path(prof_path, table)
+    stamp = _stamp(path)
+    with _order_lock:
+        return (stamp is not None and
+                _order.get(_order_key(path, key)) == stamp)
+
+
+def check_sorted(prof_path, table, key):
+    """
+    Return `True` if *table* in the profile at *prof_path* is sorted by
+    the integer value of its *key* column, reading the column unless
+    that is already known, and remembering the answer if it is.
+    """
+    if known_sorted(prof_path, table, key):
+        return True
+    path = table_path(prof_path, table)
+    stamp = _stamp(path)
+    keys = (int(row[0]) for row in iter_rows(prof_path, table, [key]))
+    if not is_sorted(keys):
+        return False
+    if stamp is not None and stamp == _stamp(path):
+        _remember(path, key, stamp)
+    return True
+
+
+def _forget(path, key):
+    # stored as null so that the note is dropped from the file as well
+    with _order_lock:
+        _order.pop(_order_key(path, key), None)
+        _new_order[_order_key(path, key)] = None
+
+
+def _order_key(path, key):
+    return '{}#{}'.format(os.path.abspath(path), key)
+
+
+def _stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime]
+
+
+def _remember(path, key, stamp, keep=True):
+    okey = _order_key(path, key)
+    with _order_lock:
+        _order[okey] = stamp
+        if keep:
+            _new_order[okey] = stamp
+
+
+class IntMap(object):
+    """
+    A compact, read-only mapping of integer keys (such as i-ids) to
+    integer values, built from the parallel sequences *keys* and
+    *values* (ideally arrays, as they are kept as arrays rather than as
+    Python objects in a dict). Lookups index the values directly when
+    the keys are contiguous and otherwise bisect the sorted keys; for a
+    repeated key, the first of its values is found.
+    """
+
+    def __init__(self, keys, values):
+        keys = keys if isinstance(keys, array) else array('l', keys)
+        values = values if isinstance(values, array) else array('l', values)
+        typecode = values.typecode
+        if not is_sorted(keys):
+            order = sorted(range(len(keys)), key=keys.__getitem__)
+            keys = array('l', (keys[i] for i in order))
+            values = array(typecode, (values[i] for i in order))
+        self._keys = keys
+        self._values = values
+        # sorted keys spanning as many integers as there are keys are
+        # contiguous only if none are repeated
+        self._contiguous = (
+            len(keys) > 0 and keys[-1] - keys[0] + 1 == len(keys) and
+            all(keys[i] < keys[i + 1] for i in range(len(keys) - 1))
+        )
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return self._index(key) is not None
+
+    def __getitem__(self, key):
+        i = self._index(key)
+        if i is None:
+            raise KeyError(key)
+        return self._values[i]
+
+    def get(self, key, default=None):
+        i = self._index(key)
+        return default if i is None else self._values[i]
+
+    def _index(self, key):
+        keys = self._keys
+        if self._contiguous:
+            i = key - keys[0]
+            return i if 0 <= i < len(keys) else None
+        i = bisect.bisect_left(keys, key)
+        if i < len(keys) and keys[i] == key:
+            return i
+        return None
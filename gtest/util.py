@@ -4,16 +4,35 @@ from __future__ import print_function
 import sys
 import os
 from os.path import (
-    abspath, relpath, basename, join as pjoin, exists, isdir, getsize
+    abspath, relpath, basename, normpath, sep, join as pjoin,
+    exists, isdir, getsize
 )
 
+import re
+import time
+import errno
+import shutil
+import signal
 import logging
+import threading
 import tempfile
 import subprocess
 from contextlib import contextmanager
 from collections import namedtuple
+from multiprocessing.pool import ThreadPool
 
-from gtest.exceptions import GTestError
+try:
+    import fcntl
+except ImportError:  # not on POSIX
+    fcntl = None
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+from gtest.exceptions import (GTestError, ProfileTimeout)
+from gtest import (cache, timing, tsdb)
 
 from delphin.interfaces import ace
 
@@ -51,8 +70,8 @@ def pushd(path):
     os.chdir(prev_dir)
 
 
-def temp_dir():
-    tmp = tempfile.mkdtemp()
+def temp_dir(basedir=None):
+    tmp = tempfile.mkdtemp(dir=basedir)
     debug('Temporary directory created at {}'.format(tmp))
     return tmp
 
@@ -92,6 +111,14 @@ def make_profile_key(path, basedir):
         return path
 
 
+def profile_name(key):
+    """
+    Return a filesystem-safe name for the profile given by *key*, used
+    for its destination directory and log file in the working directory.
+    """
+    return '_'.join(normpath(re.sub(r'^:', '', key)).split(sep))
+
+
 def dir_is_profile(path, skeleton=False):
     if skeleton:
         files = ['item', 'relations']
@@ -99,21 +126,60 @@ def dir_is_profile(path, skeleton=False):
         # this should be enough
         files = ['item', 'relations', 'parse', 'result']
     try:
-        return all(getsize(pjoin(path, f)) > 0 for f in files)
+        return all(getsize(tsdb.table_path(path, f)) > 0 for f in files)
     except OSError:
         return False
 
+#
+# CONCURRENCY
+#
+
+def run_jobs(func, items, jobs=1, cost=None):
+    """
+    Yield the result of calling *func* on each of *items*, in order.
+    If *jobs* is greater than 1, up to *jobs* calls are run at once in
+    a thread pool (the work is mostly done by subprocesses), but results
+    are still yielded in the order of *items*. If *cost* is also given,
+    it is called on each item for its expected duration, and the items
+    are started in decreasing order of it (longest first).
+    """
+    if not jobs or jobs <= 1:
+        for item in items:
+            yield func(item)
+    else:
+        pool = ThreadPool(jobs)
+        try:
+            if cost is None:
+                for result in pool.imap(func, items):
+                    yield result
+            else:
+                items = list(items)
+                costs = [cost(item) for item in items]
+                pending = [None] * len(items)
+                # sorting is stable, so equal costs keep their order
+                for i in sorted(range(len(items)), key=lambda i: -costs[i]):
+                    pending[i] = pool.apply_async(func, (items[i],))
+                for p in pending:
+                    yield p.get()
+        finally:
+            pool.terminate()
+            pool.join()
+
 #
 # Prepare for test run
 #
 
+# memory-backed filesystem for working directories with --tmpfs
+TMPFS_DIR = '/dev/shm'
+
 
 def prepare_working_directory(args, log=None):
     """
     Prepare args.working_dir for a test. If args.working_dir is unset,
-    a temporary directory will be created and args.working_dir will be
-    set to its path. Otherwise, if args.working_dir exists, it will be
-    used, and if not, it will be created.
+    a temporary directory will be created (on tmpfs if args.tmpfs is
+    set) and args.working_dir will be set to its path. Otherwise, if
+    args.working_dir exists, it will be used, and if not, it will be
+    created.
     """
     qualifier = ''
     if args.working_dir:
@@ -130,6 +196,15 @@ def prepare_working_directory(args, log=None):
                 raise
         else:
             qualifier = 'existing '
+    elif args.tmpfs:
+        if isdir(TMPFS_DIR):
+            args.working_dir = temp_dir(TMPFS_DIR)
+            qualifier = 'temporary in-memory '
+        else:
+            warning('{} is not available; using the default temporary '
+                    'directory'.format(TMPFS_DIR), log)
+            args.working_dir = temp_dir()
+            qualifier = 'temporary '
     else:
         args.working_dir = temp_dir()
         qualifier = 'temporary '
@@ -153,10 +228,15 @@ def prepare_compiled_grammar(args, log=None, ace_log=None):
                 'Compiled grammar not found: {}'
                 .format(args.compiled_grammar.path)
             )
-    else:
+    elif args.no_cache:
         compiled_grammar = pjoin(args.working_dir, 'gram.dat')
         ace_compile(args.ace_config.path, compiled_grammar, log=ace_log)
         args.compiled_grammar = make_keypath(compiled_grammar, '')
+    else:
+        compiled_grammar = cached_grammar(args, log=log, ace_log=ace_log)
+        args.compiled_grammar = make_keypath(compiled_grammar, '')
+        # cached images are named by their content key
+        args.grammar_key = basename(compiled_grammar)[:-len('.dat')]
     info('Using grammar image: {}'.format(args.compiled_grammar.path), log)
 
 
@@ -174,9 +254,103 @@ def get_grammar(args, tmp):
     return grm
 
 
+def grammar_key(args):
+    """
+    Return a digest identifying the grammar image in use. Images from
+    the cache already have one; others are hashed on first use.
+    """
+    if getattr(args, 'grammar_key', None) is None:
+        args.grammar_key = cache.hash_files([args.compiled_grammar.path])
+    return args.grammar_key
+
+
+def cached_grammar(args, log=None, ace_log=None):
+    """
+    Return the path of a grammar image for `args.ace_config` from the
+    image cache under `args.cache_dir`, compiling it first if no image
+    exists for the current config, grammar files, and ACE version. The
+    image is held (see cache.hold()) until `args.image_hold` is closed
+    or replaced by another call, so concurrent runs do not evict it.
+    """
+    cfg_path = args.ace_config.path
+    files = grammar_files(cfg_path)
+    key = cache.hash_files(
+        files, extra=[ace_version()], basedir=os.path.dirname(cfg_path)
+    )
+    debug('Grammar cache key {} from {} files'.format(key, len(files)), log)
+    image = cache.cache_path(args.cache_dir, 'grammars', key + '.dat')
+    with cache.file_lock(image + '.lock'):
+        if exists(image):
+            cache.touch(image)
+            info('Found cached grammar image: {}'.format(image), log)
+        else:
+            tmp = image + '.tmp'
+            try:
+                ace_compile(cfg_path, tmp, log=ace_log)
+                os.rename(tmp, image)
+            finally:
+                if exists(tmp):
+                    os.remove(tmp)  # compilation failed
+        held = getattr(args, 'image_hold', None)
+        args.image_hold = cache.hold(image)
+        if held is not None:
+            held.close()  # e.g. the previous image with --watch
+    cache.evict(os.path.dirname(image), args.cache_size * 1024 * 1024,
+                keep=[image])
+    return image
+
+
+# ACE config and TDL files reference other files with quoted strings,
+# e.g. `grammar-top := "../english.tdl".` or `:include "lexicon".`
+_quoted_re = re.compile(r'"([^"\n]+)"')
+_include_re = re.compile(r'^\s*:include\s+"([^"\n]+)"', re.MULTILINE)
+
+
+def grammar_files(cfg_path):
+    """
+    Return the sorted list of files pulled in by the ACE config file at
+    *cfg_path*. Files in the config's directory are scanned for any
+    quoted path, while other TDL files are only scanned for `:include`
+    directives.
+    """
+    cfg_dir = abspath(os.path.dirname(cfg_path))
+    seen = set()
+    agenda = [abspath(cfg_path)]
+    while agenda:
+        path = agenda.pop()
+        if path in seen:
+            continue
+        seen.add(path)
+        if os.path.dirname(path) == cfg_dir:
+            pattern = _quoted_re
+        elif path.endswith('.tdl'):
+            pattern = _include_re
+        else:
+            continue  # e.g. maxent models or other binary files
+        with open(path, 'rb') as f:
+            text = f.read().decode('utf-8', 'replace')
+        basedir = os.path.dirname(path)
+        for ref in pattern.findall(text):
+            for candidate in (ref, ref + '.tdl'):
+                candidate = abspath(pjoin(basedir, candidate))
+                if os.path.isfile(candidate):
+                    agenda.append(candidate)
+                    break
+    return sorted(seen)
+
+
+def ace_version():
+    """
+    Return the version string reported by `ace -V`.
+    """
+    out = subprocess.check_output(['ace', '-V'], stderr=subprocess.STDOUT)
+    return out.decode('utf-8', 'replace').strip()
+
+
 def ace_compile(cfg_path, out_path, log=None):
     debug('Compiling grammar at {}'.format(abspath(cfg_path)), log)
-    ace.compile(cfg_path, out_path, log=log)
+    with timing.phase('compile', process_children=True):
+        ace.compile(cfg_path, out_path, log=log)
     debug('Compiled grammar written to {}'.format(abspath(out_path)), log)
 
 
@@ -184,13 +358,522 @@ def ace_compile(cfg_path, out_path, log=None):
 # PARSING
 #
 
+def parse_profile(skel_dir, dest_dir, args, log=None):
+    """
+    Create the profile at *dest_dir* from the skeleton at *skel_dir* and
+    parse it with the grammar image and options in *args*, either with
+    art, with a pool of running ACE processes if `args.ace_pool` is set
+    (see gtest.engine), or on gTest workers if `args.worker_pool` is
+    set (see gtest.worker). If `args.shards` is greater than 1,
+    the skeleton is split and the parts are parsed concurrently (see
+    parse_sharded()). If `args.profile_timeout` is set, parsing that
+    takes longer is stopped and ProfileTimeout is raised. The time
+    taken is recorded in `args.history` (see gtest.history), if set.
+    """
+    history = getattr(args, 'history', None)
+    start = time.time()
+    try:
+        with time_limit(getattr(args, 'profile_timeout', None)):
+            if args.shards > 1:
+                parse_sharded(skel_dir, dest_dir, args, log=log)
+            else:
+                _parse(skel_dir, dest_dir, args, log=log)
+    except ProfileTimeout:
+        # the time until the timeout is still a lower bound
+        if history is not None:
+            history.record(skel_dir, time.time() - start)
+        raise
+    if history is not None:
+        history.record(skel_dir, time.time() - start)
+    if tsdb.check_sorted(skel_dir, 'item', 'i-id'):
+        # parses are numbered by i-id and written in item order
+        for table, key in SORTED_PARSE_TABLES:
+            tsdb.mark_sorted(dest_dir, table, key)
+
+
+def _parse(skel_dir, dest_dir, args, log=None):
+    with timing.phase('prepare'):
+        prepare_profile(skel_dir, dest_dir, args, log=log)
+    with timing.phase('parse', engine=args.engine):
+        if getattr(args, 'worker_pool', None) is not None:
+            args.worker_pool.parse_profile(dest_dir, args, log=log)
+        elif args.ace_pool is not None:
+            args.ace_pool.parse_profile(dest_dir, log=log)
+        else:
+            run_art(
+                args.compiled_grammar.path,
+                dest_dir,
+                options=args.art_opts,
+                ace_preprocessor=args.preprocessor,
+                ace_options=args.ace_opts,
+                log=log
+            )
+
+
+def parse_sharded(skel_dir, dest_dir, args, log=None):
+    """
+    Split the skeleton at *skel_dir* into `args.shards` sub-skeletons,
+    parse them concurrently with separate art/ACE processes, and merge
+    the results into a single profile at *dest_dir*.
+    """
+    shard_dir = dest_dir + '.shards'
+    if isdir(shard_dir):
+        shutil.rmtree(shard_dir)
+    os.mkdir(shard_dir)
+    skels = split_skeleton(skel_dir, shard_dir, args.shards)
+    if len(skels) < 2:
+        shutil.rmtree(shard_dir)
+        _parse(skel_dir, dest_dir, args, log=log)
+        return
+    debug('Split {} into {} shards'.format(abspath(skel_dir), len(skels)),
+          log)
+
+    context = timing.current_context()
+    limit = current_deadline()
+
+    def parse_shard(i):
+        shard_dest = pjoin(shard_dir, str(i))
+        with open(pjoin(shard_dir, 'run-{}.log'.format(i)), 'w') as slog, \
+                timing.context(shard=i, **context), deadline(limit):
+            _parse(skels[i], shard_dest, args, log=slog)
+        return shard_dest
+
+    try:
+        shards = list(run_jobs(parse_shard, range(len(skels)),
+                               jobs=len(skels)))
+    except (subprocess.CalledProcessError, OSError):
+        error('Failed to parse a shard. See logs in {}'.format(shard_dir),
+              log)
+        raise
+    with timing.phase('merge'):
+        prepare_profile(skel_dir, dest_dir, args, log=log)
+        merge_profiles(shards, dest_dir, skel_dir, log=log)
+    shutil.rmtree(shard_dir)
+
+
+def split_skeleton(skel_dir, dest_dir, n):
+    """
+    Split the item table of the skeleton at *skel_dir* into at most *n*
+    contiguous parts, each written as a sub-skeleton under *dest_dir*
+    (other skeleton files are linked as-is). Return the list of
+    sub-skeleton paths.
+    """
+    with tsdb.open_table(skel_dir, 'item') as f:
+        count = sum(1 for _ in f)
+    size = max(1, -(-count // n))  # ceiling division
+    others = [fn for fn in os.listdir(skel_dir)
+              if fn not in ('item', 'item.gz')
+              and os.path.isfile(pjoin(skel_dir, fn))]
+    skels = []
+    out = None
+    try:
+        with tsdb.open_table(skel_dir, 'item') as f:
+            for i, line in enumerate(f):
+                if i % size == 0:
+                    if out is not None:
+                        out.close()
+                    skel = pjoin(dest_dir, 'skel-{}'.format(len(skels)))
+                    os.mkdir(skel)
+                    for fn in others:
+                        _link_file(pjoin(skel_dir, fn), pjoin(skel, fn))
+                    out = open(pjoin(skel, 'item'), 'w')
+                    skels.append(skel)
+                out.write(line)
+    finally:
+        if out is not None:
+            out.close()
+    return skels
+
+
+def filter_skeleton(skel_dir, dest_dir, keep):
+    """
+    Write a sub-skeleton of the skeleton at *skel_dir* to *dest_dir*
+    with only the items for which *keep*, called with the list of
+    (escaped) values of the item's row, returns `True`. Other skeleton
+    files are linked as-is. Return the number of items kept.
+    """
+    if isdir(dest_dir):
+        shutil.rmtree(dest_dir)
+    os.makedirs(dest_dir)
+    for fn in os.listdir(skel_dir):
+        src = pjoin(skel_dir, fn)
+        if fn not in ('item', 'item.gz') and os.path.isfile(src):
+            _link_file(src, pjoin(dest_dir, fn))
+    n = 0
+    with tsdb.open_table(skel_dir, 'item') as f, \
+            open(pjoin(dest_dir, 'item'), 'w') as out:
+        for line in f:
+            if keep(line.rstrip('\n').split('@')):
+                out.write(line)
+                n += 1
+    return n
+
+
+def merge_profiles(shards, dest_dir, skel_dir, log=None):
+    """
+    Append the tables produced by parsing each of *shards* (i.e., those
+    not given by the skeleton at *skel_dir*) to the profile at
+    *dest_dir*. Since art numbers parses by i-id, rows can be
+    concatenated without renumbering; the `run` table is only taken
+    from the first shard.
+    """
+    skel_tables = set(
+        tsdb.table_name(fn) for fn in os.listdir(skel_dir)
+        if getsize(pjoin(skel_dir, fn)) > 0
+    )
+    tables = [fn for fn in os.listdir(shards[0])
+              if tsdb.table_name(fn) not in skel_tables and fn != 'relations']
+    for table in tables:
+        path = pjoin(dest_dir, table)
+        if exists(path):
+            os.remove(path)  # it may be linked to a skeleton file
+        with open(path, 'w') as out:
+            for shard in (shards[:1] if table == 'run' else shards):
+                if exists(pjoin(shard, table)):
+                    with open(pjoin(shard, table)) as f:
+                        shutil.copyfileobj(f, out)
+    debug('Merged {} shards into {}'.format(len(shards), dest_dir), log)
+
+
+def finish_profile(prof_path, args):
+    """
+    Note that the working profile at *prof_path* is no longer needed for
+    analysis, so it may be compressed if `args.compressor` is set.
+    """
+    compressor = getattr(args, 'compressor', None)
+    if compressor is not None:
+        compressor.submit(prof_path)
+
+
+class Compressor(object):
+    """
+    Gzip the tables (larger than *min_size* bytes) of finished working
+    profiles in a background thread; see tsdb.compress_profile(). Call
+    close() to wait for pending profiles.
+    """
+
+    def __init__(self, min_size=0):
+        self.min_size = min_size
+        self._queue = Queue()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, prof_path):
+        self._queue.put(prof_path)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            prof_path = self._queue.get()
+            if prof_path is None:
+                break
+            try:
+                tsdb.compress_profile(prof_path, min_size=self.min_size)
+                debug('Compressed profile: {}'.format(prof_path))
+            except (IOError, OSError) as ex:
+                warning('Could not compress profile {}: {}'
+                        .format(prof_path, ex))
+
+
+# Subprocesses currently running; see check_call()
+_processes = set()
+_processes_lock = threading.Lock()
+
+# run subprocesses in their own process group so that terminating one
+# also terminates its children (e.g. ACE started by art)
+if sys.version_info >= (3, 2):
+    _popen_group = {'start_new_session': True}
+else:
+    _popen_group = {'preexec_fn': os.setsid}
+
+
+def check_call(cmd, log=None):
+    """
+    Like subprocess.check_call(), with output going to *log*, but the
+    process is tracked so it can be stopped by terminate_processes().
+    If a deadline is in effect (see time_limit()), the process (and its
+    children) is killed when it passes and ProfileTimeout is raised.
+    """
+    limit = current_deadline()
+    check_deadline(limit)
+    p = subprocess.Popen(cmd, stdout=log, stderr=log, close_fds=True,
+                         **_popen_group)
+    with _processes_lock:
+        _processes.add(p)
+    if limit is not None:
+        watchdog.watch(p, limit.at)
+    try:
+        retcode = _wait(p)
+    finally:
+        with _processes_lock:
+            _processes.discard(p)
+        expired = limit is not None and watchdog.unwatch(p)
+    if expired:
+        error('Stopped {} at the time limit'.format(cmd[0]), log)
+        check_deadline(limit, expired=True)
+    if retcode:
+        raise subprocess.CalledProcessError(retcode, cmd)
+
+
+def _wait(p):
+    # wait4() also reports the resource usage of the process (and of
+    # its children it waited for, e.g. ACE under art) for gtest.timing
+    if not hasattr(os, 'wait4'):
+        return p.wait()
+    while True:
+        try:
+            _, status, usage = os.wait4(p.pid, 0)
+            break
+        except OSError as ex:
+            if ex.errno != errno.EINTR:
+                raise
+    if os.WIFSIGNALED(status):
+        p.returncode = -os.WTERMSIG(status)
+    else:
+        p.returncode = os.WEXITSTATUS(status)
+    timing.child_usage(usage)
+    return p.returncode
+
+
+def terminate_processes():
+    """
+    Terminate all subprocesses started by check_call() that are still
+    running, along with their children.
+    """
+    with _processes_lock:
+        processes = list(_processes)
+    for p in processes:
+        try:
+            os.killpg(p.pid, signal.SIGTERM)
+        except OSError:
+            pass  # already finished
+
+
+#
+# TIME LIMITS
+#
+
+# the time (from time.time()) by which parsing must finish, and the
+# number of seconds it was given
+Deadline = namedtuple('Deadline', 'at seconds')
+
+_limits = threading.local()
+
+
+def current_deadline():
+    """
+    Return the Deadline in effect in this thread, or `None`.
+    """
+    return getattr(_limits, 'deadline', None)
+
+
+@contextmanager
+def deadline(limit):
+    """
+    Put the Deadline *limit* (or no deadline, if `None`) in effect in
+    this thread for the duration of the context. Use this to give other
+    threads the deadline of the current one.
+    """
+    previous = current_deadline()
+    _limits.deadline = limit
+    try:
+        yield limit
+    finally:
+        _limits.deadline = previous
+
+
+def time_limit(seconds):
+    """
+    Return a context in which subprocesses started by check_call() (or
+    parsers of the ACE engine) must finish within *seconds* of entering
+    it. An earlier deadline that is already in effect is kept. If
+    *seconds* is `None` or 0, no new limit is added.
+    """
+    limit = current_deadline()
+    if seconds:
+        at = time.time() + seconds
+        if limit is None or at < limit.at:
+            limit = Deadline(at, seconds)
+    return deadline(limit)
+
+
+def check_deadline(limit, expired=False):
+    """
+    Raise ProfileTimeout if the Deadline *limit* has passed (or, if
+    *expired* is `True`, was found to have passed elsewhere).
+    """
+    if limit is not None and (expired or time.time() >= limit.at):
+        raise ProfileTimeout(
+            'time limit of {} seconds exceeded'.format(limit.seconds)
+        )
+
+
+class Watchdog(object):
+    """
+    A daemon thread that kills watched processes that are still running
+    at their deadline. Processes started by check_call() are killed
+    along with their process group (e.g. ACE started by art).
+    """
+
+    def __init__(self):
+        self._watched = {}  # process -> (deadline, kill process group)
+        self._expired = set()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def watch(self, p, at, group=True):
+        """
+        Kill the subprocess.Popen object *p* if it is still watched at
+        time *at*. If *group* is `True`, kill its process group instead.
+        """
+        with self._cond:
+            self._watched[p] = (at, group)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+
+    def unwatch(self, p):
+        """
+        Stop watching *p*. Return `True` if it was killed for passing
+        its deadline.
+        """
+        with self._cond:
+            self._watched.pop(p, None)
+            if p in self._expired:
+                self._expired.discard(p)
+                return True
+        return False
+
+    def _run(self):
+        # processes are not polled, as they are reaped by their waiters
+        with self._cond:
+            while True:
+                now = time.time()
+                for p, (at, group) in list(self._watched.items()):
+                    if at <= now:
+                        del self._watched[p]
+                        self._expired.add(p)
+                        _kill(p, group)
+                if self._watched:
+                    at = min(at for at, _ in self._watched.values())
+                    self._cond.wait(at - now)
+                else:
+                    self._cond.wait()
+
+
+def _kill(p, group):
+    try:
+        if group:
+            os.killpg(p.pid, signal.SIGKILL)
+        else:
+            p.kill()
+    except OSError:
+        pass  # already finished
+
+
+watchdog = Watchdog()
+
+
+# tables written by parsing; these are never linked from skeletons
+PARSE_TABLES = (
+    'run', 'parse', 'result', 'rule', 'edge', 'tree', 'decision',
+    'preference', 'update', 'fold', 'score'
+)
+
+# (table, key) of those written in item order by parsing
+SORTED_PARSE_TABLES = (
+    ('parse', 'i-id'), ('parse', 'parse-id'), ('result', 'parse-id')
+)
+
+# Linux ioctl to share a file's data copy-on-write (a "reflink")
+_FICLONE = 0x40049409
+
+
+def prepare_profile(skel_dir, dest_dir, args, log=None):
+    """
+    Create the profile at *dest_dir* from the skeleton at *skel_dir*,
+    with mkprof if `args.use_mkprof` is set and otherwise in-process
+    with make_profile().
+    """
+    if args.use_mkprof:
+        mkprof(skel_dir, dest_dir, log=log)
+    else:
+        make_profile(skel_dir, dest_dir, log=log)
+
+
+def make_profile(skel_dir, dest_dir, log=None):
+    """
+    Create the profile at *dest_dir* from the skeleton at *skel_dir*
+    like `mkprof -s`, but without a subprocess or copying: the files of
+    the skeleton are hard-linked (or reflinked or copied where that is
+    not possible, e.g. across filesystems; gzipped tables are
+    decompressed) and the other tables of the relations file are
+    created empty. Any existing profile at
+    *dest_dir* is removed first, so linked skeleton files are never
+    written through.
+    """
+    debug('Preparing profile: {}'.format(abspath(skel_dir)), log)
+    try:
+        if isdir(dest_dir):
+            shutil.rmtree(dest_dir)
+        os.makedirs(dest_dir)
+        linked = set()
+        for fn in os.listdir(skel_dir):
+            src = pjoin(skel_dir, fn)
+            table = tsdb.table_name(fn)
+            if table in PARSE_TABLES or not os.path.isfile(src):
+                continue
+            if table != fn:
+                # the parser may not read gzipped tables
+                with tsdb.open_table(skel_dir, table) as f, \
+                        open(pjoin(dest_dir, table), 'w') as out:
+                    shutil.copyfileobj(f, out)
+            else:
+                _link_file(src, pjoin(dest_dir, fn))
+            linked.add(table)
+        for table in _relation_names(pjoin(skel_dir, 'relations')):
+            if table not in linked:
+                open(pjoin(dest_dir, table), 'w').close()
+    except (IOError, OSError):
+        error('Failed to prepare profile at {}'.format(dest_dir), log)
+        raise
+    debug('Completed preparing profile. Output at {}'.format(dest_dir), log)
+
+
+def _link_file(src, dst):
+    try:
+        os.link(src, dst)
+        return
+    except (OSError, AttributeError):
+        pass
+    if fcntl is not None and sys.platform.startswith('linux'):
+        with open(src, 'rb') as s, open(dst, 'wb') as d:
+            try:
+                fcntl.ioctl(d.fileno(), _FICLONE, s.fileno())
+                return
+            except (IOError, OSError):
+                pass  # not supported; fall back to copying
+    shutil.copyfile(src, dst)
+
+
+
+def _relation_names(path):
+    # table names are the unindented lines ending with a colon
+    with open(path) as f:
+        return [line.strip()[:-1] for line in f
+                if line[:1].strip() and line.rstrip().endswith(':')]
+
+
 def mkprof(skel_dir, dest_dir, log=None):
     debug('Preparing profile: {}'.format(abspath(skel_dir)), log)
     try:
-        subprocess.check_call(
-            ['mkprof', '-s', skel_dir, dest_dir],
-            stdout=log, stderr=log, close_fds=True
-        )
+        check_call(['mkprof', '-s', skel_dir, dest_dir], log=log)
     except (subprocess.CalledProcessError, OSError):
         error(
             'Failed to prepare profile with mkprof. See {}'
@@ -211,10 +894,8 @@ def run_art(grm, dest_dir, options=None,
             gram=grm,
             opts=' '.join(ace_options or [])
         )
-        subprocess.check_call(
-            ['art', '-a', ace_cmd, dest_dir] + (options or []),
-            stdout=log, stderr=log, close_fds=True
-        )
+        check_call(['art', '-a', ace_cmd, dest_dir] + (options or []),
+                   log=log)
     except (subprocess.CalledProcessError, OSError):
         error(
             'Failed to parse profile with art. See {}'
@@ -0,0 +1,172 @@
+"""
+Watch mode: test again whenever the grammar or the test data change.
+
+After the first run of a test with `--watch`, gTest polls the files of
+the grammar (those pulled in by the ACE config, see
+gtest.util.grammar_files()) and of the tested skeletons and gold
+profiles. When grammar files change, the grammar image is recompiled
+(through the image cache), the parsing engine is restarted with it, and
+every profile is tested again; when only some skeletons or gold
+profiles change, only those profiles are tested again. Everything else
+stays loaded between runs: the Python process, the found profiles,
+item statistics, gold MRSs (see gtest.regression.gold_in_memory()),
+and the ACE processes or worker connections of the parsing engine.
+With `--items`, the original skeletons are watched, and the items of
+the profiles to test are selected again (see gtest.items) for each run.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+from subprocess import CalledProcessError
+from os.path import (basename, join as pjoin)
+
+from gtest.exceptions import GTestError
+from gtest.util import (error, prepare_compiled_grammar, grammar_files)
+from gtest.engine import (prepare_engine, close_engine)
+from gtest.skeletons import forget_profile_stats
+from gtest.items import select_items
+
+
+def watch(args, test, interval=1.0):
+    """
+    Call *test* (e.g. gtest.regression.regression_test) with *args*
+    again for the profiles affected by each change, checking every
+    *interval* seconds, until interrupted.
+    """
+    selecting = getattr(args, 'items', None) is not None
+    if selecting:
+        all_profiles, skel_dir = args.unfiltered
+    else:
+        all_profiles, skel_dir = args.profiles, args.skel_dir
+    recompile = _compiled_by_gtest(args)
+    grammar, files = _grammar_stamp(args, recompile)
+    profiles = _profile_stamps(args, all_profiles, skel_dir)
+    print('Watching for changes (press Ctrl-C to stop)...')
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(interval)
+            new_grammar, _ = _grammar_stamp(args, recompile, files)
+            new_profiles = _profile_stamps(args, all_profiles, skel_dir)
+            if new_grammar == grammar and new_profiles == profiles:
+                continue
+            # wait for the files to settle, as saving may take a while
+            while True:
+                time.sleep(interval)
+                settled_grammar, new_files = _grammar_stamp(args, recompile)
+                settled_profiles = _profile_stamps(args, all_profiles,
+                                                   skel_dir)
+                if (settled_grammar == new_grammar and
+                        settled_profiles == new_profiles):
+                    break
+                new_grammar, new_profiles = settled_grammar, settled_profiles
+            if new_grammar != grammar or args.compiled_grammar is None:
+                changed = all_profiles  # (or the last compilation failed)
+            else:
+                changed = [p for p in all_profiles
+                           if new_profiles[p.path] != profiles[p.path]]
+            grammar, files, profiles = new_grammar, new_files, new_profiles
+            for skel in changed:
+                forget_profile_stats(skel.path)
+            print('\n--- {}: {} changed; testing {} profile(s)'.format(
+                time.strftime('%H:%M:%S'),
+                'grammar' if changed is all_profiles else 'test data',
+                len(changed)
+            ))
+            sys.stdout.flush()
+            if changed is all_profiles and not _reload_grammar(args,
+                                                               recompile):
+                continue
+            args.profiles, args.skel_dir = changed, skel_dir
+            try:
+                if selecting:
+                    select_items(args)  # note: args may change
+                test(args)
+            except (GTestError, CalledProcessError, IOError, OSError) as ex:
+                error('Test run failed: {}'.format(ex))
+            finally:
+                args.profiles, args.skel_dir = all_profiles, skel_dir
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        print()
+
+
+def _compiled_by_gtest(args):
+    # images from the cache are named by their key and images compiled
+    # without the cache are in the working directory; anything else was
+    # given with -C and is used as is
+    path = args.compiled_grammar.path
+    key = getattr(args, 'grammar_key', None)
+    return (path == pjoin(args.working_dir, 'gram.dat') or
+            (key is not None and basename(path) == key + '.dat'))
+
+
+def _grammar_stamp(args, recompile, files=None):
+    """
+    Return the modification times of the grammar files (or of the given
+    image if gTest does not compile it) and the list of files. The
+    files pulled in by the config are only searched again if *files* is
+    not given.
+    """
+    if not recompile:
+        files = [args.compiled_grammar.path]
+    elif files is None:
+        files = grammar_files(args.ace_config.path)
+    return _stamp(files), files
+
+
+def _profile_stamps(args, profiles, skel_dir):
+    """
+    Return a dictionary mapping the path of each skeleton KeyPath in
+    *profiles* (found under the KeyPath *skel_dir*) to the modification
+    times of its files and of its gold profile's files.
+    """
+    stamps = {}
+    for skel in profiles:
+        dirs = [skel.path]
+        if getattr(args, 'gold_dir', None) is not None:
+            dirs.append(pjoin(args.gold_dir.path,
+                              os.path.relpath(skel.path, skel_dir.path)))
+        files = []
+        for d in dirs:
+            try:
+                files.extend(pjoin(d, fn) for fn in sorted(os.listdir(d)))
+            except OSError:
+                pass  # removed; the test reports it
+        stamps[skel.path] = _stamp(files)
+    return stamps
+
+
+def _stamp(files):
+    stamp = []
+    for path in files:
+        try:
+            st = os.stat(path)
+            stamp.append((path, st.st_size, st.st_mtime))
+        except OSError:
+            stamp.append((path, None, None))
+    return stamp
+
+
+def _reload_grammar(args, recompile):
+    """
+    Recompile the grammar image (if gTest compiled it) and restart the
+    parsing engine with it. Return `False` if compilation failed.
+    """
+    args.grammar_key = None
+    if recompile:
+        args.compiled_grammar = None
+        args.ace_config = args.ace_config.path
+        ace_log_path = pjoin(args.working_dir, 'ace.log')
+        try:
+            with open(ace_log_path, 'w') as ace_log:
+                prepare_compiled_grammar(args, ace_log=ace_log)
+        except (CalledProcessError, OSError):
+            error('Grammar compilation failed; see {}'.format(ace_log_path))
+            return False
+    close_engine(args)
+    prepare_engine(args)  # note: args may change
+    return True
@@ -0,0 +1,483 @@
+"""
+Distributed parsing with gTest workers.
+
+A worker (`gTest W`) listens on a TCP socket for parsing jobs. A test
+run given `--workers` prepares each working profile locally as usual,
+sends it to a worker along with the options for art and ACE, and
+receives the tables written by parsing; the tests themselves (e.g.
+comparing with gold) are run locally on the parsed profile. Grammar
+images are identified by their hash and sent to each worker only if it
+does not have them already.
+
+Each message is a JSON header preceded by its length (4 bytes, network
+byte order) and followed by the number of bytes of payload given by
+the header's `size`. Workers do not authenticate clients and run the
+ACE command (including any preprocessor) they are sent, so they should
+only listen on trusted networks.
+"""
+
+import os
+import re
+import io
+import sys
+import json
+import time
+import socket
+import struct
+import shutil
+import tarfile
+import tempfile
+import threading
+from subprocess import CalledProcessError
+from os.path import (abspath, basename, dirname, isdir, isfile, join as pjoin)
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+
+from gtest import cache
+from gtest.exceptions import ProfileTimeout
+from gtest.util import (
+    debug, info, warning, error, prepare_working_directory, run_art,
+    time_limit, current_deadline, check_deadline, PARSE_TABLES
+)
+
+DEFAULT_PORT = 7770
+
+_LENGTH = struct.Struct('!I')
+CHUNK_SIZE = 1 << 20
+
+
+def run(args):
+    prepare_working_directory(args)
+    if args.no_cache:
+        image_dir = pjoin(args.working_dir, 'images')
+    else:
+        image_dir = pjoin(args.cache_dir, 'images')
+    worker = Worker(image_dir, args.working_dir,
+                    max_size=args.cache_size * 1024 * 1024)
+    server = WorkerServer(parse_address(args.listen), worker)
+    host, port = server.server_address[:2]
+    print('gTest worker listening on {}:{}'.format(host, port))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def parse_address(s):
+    """
+    Return the (host, port) pair for *s*, given as `HOST:PORT`, `HOST`,
+    or `:PORT`; the default host is `localhost`.
+    """
+    host, port = s.rsplit(':', 1) if ':' in s else (s, '')
+    return (host or 'localhost', int(port) if port else DEFAULT_PORT)
+
+
+#
+# MESSAGES
+#
+
+def send_message(sock, header, payload=b''):
+    """
+    Send the JSON-serializable dictionary *header* and the bytes
+    *payload* on *sock*.
+    """
+    data = json.dumps(dict(header, size=len(payload))).encode('utf-8')
+    sock.sendall(_LENGTH.pack(len(data)) + data)
+    if payload:
+        sock.sendall(payload)
+
+
+def send_file_message(sock, header, path):
+    """
+    Send *header* on *sock* with the contents of the file at *path* as
+    the payload, without reading the whole file into memory.
+    """
+    size = os.path.getsize(path)
+    data = json.dumps(dict(header, size=size)).encode('utf-8')
+    sock.sendall(_LENGTH.pack(len(data)) + data)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sock.sendall(chunk)
+
+
+def recv_header(sock):
+    """
+    Receive and return the header of the next message on *sock*. Its
+    payload must be read next with recv_payload().
+    """
+    length = _LENGTH.unpack(_recv_exact(sock, _LENGTH.size))[0]
+    return json.loads(_recv_exact(sock, length).decode('utf-8'))
+
+
+def recv_payload(sock, header, path=None):
+    """
+    Receive the payload of the message with *header* on *sock*. If
+    *path* is given, the payload is written to a file there (and `None`
+    is returned); otherwise it is returned as bytes.
+    """
+    size = header.get('size', 0)
+    if path is None:
+        return _recv_exact(sock, size)
+    with open(path, 'wb') as f:
+        while size:
+            chunk = _recv_some(sock, min(size, CHUNK_SIZE))
+            f.write(chunk)
+            size -= len(chunk)
+
+
+def recv_message(sock):
+    """
+    Receive the next message on *sock* and return its header and
+    payload.
+    """
+    header = recv_header(sock)
+    return header, recv_payload(sock, header)
+
+
+def _recv_exact(sock, n):
+    chunks = []
+    while n:
+        chunk = _recv_some(sock, min(n, CHUNK_SIZE))
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b''.join(chunks)
+
+
+def _recv_some(sock, n):
+    chunk = sock.recv(n)
+    if not chunk:
+        raise socket.error('connection closed')
+    return chunk
+
+
+def pack_profile(prof_path, tables=None):
+    """
+    Return a gzipped tar archive of the files of the profile at
+    *prof_path*, or only of those in *tables* if given.
+    """
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz', compresslevel=1) as tar:
+        for fn in sorted(os.listdir(prof_path)):
+            path = pjoin(prof_path, fn)
+            if isfile(path) and (tables is None or fn in tables):
+                tar.add(path, arcname=fn)
+    return buf.getvalue()
+
+
+def unpack_profile(data, prof_path):
+    """
+    Write the files of the archive *data* (see pack_profile()) into the
+    profile at *prof_path*, replacing (not writing through) existing
+    files.
+    """
+    with tarfile.open(fileobj=io.BytesIO(data), mode='r:gz') as tar:
+        for member in tar.getmembers():
+            name = member.name
+            if not member.isfile() or basename(name) != name or \
+                    name in ('', '.', '..'):
+                raise ValueError('Unexpected file in archive: {}'
+                                 .format(name))
+            path = pjoin(prof_path, name)
+            if os.path.lexists(path):
+                os.remove(path)
+            with open(path, 'wb') as f:
+                shutil.copyfileobj(tar.extractfile(member), f)
+
+
+#
+# WORKER
+#
+
+class Worker(object):
+    """
+    Parses the profiles sent by clients with art, using grammar images
+    kept in *image_dir* and temporary profiles under *work_dir*. If
+    *max_size* is given, the least recently used images are removed
+    when their total size in bytes exceeds it.
+    """
+
+    def __init__(self, image_dir, work_dir, max_size=None):
+        self.image_dir = image_dir
+        self.work_dir = work_dir
+        self.max_size = max_size
+        if not isdir(image_dir):
+            os.makedirs(image_dir)
+
+    def image_path(self, image):
+        if not re.match(r'^[0-9a-f]+$', image):
+            raise ValueError('Invalid image hash: {}'.format(image))
+        return pjoin(self.image_dir, image + '.dat')
+
+    def has_image(self, header):
+        path = self.image_path(header['image'])
+        if not isfile(path):
+            return {'have': False}
+        cache.touch(path)
+        return {'have': True}
+
+    def store_image(self, sock, header):
+        """
+        Receive the grammar image in the payload of *header* on *sock*.
+        """
+        path = self.image_path(header['image'])
+        tmp = '{}.{}.{}.tmp'.format(path, os.getpid(),
+                                    threading.current_thread().ident)
+        try:
+            recv_payload(sock, header, path=tmp)
+            os.rename(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        info('Received grammar image: {}'.format(path))
+        if self.max_size is not None:
+            cache.evict(self.image_dir, self.max_size, keep=[path])
+        return {'ok': True}
+
+    def parse(self, header, payload):
+        """
+        Parse the profile in the archive *payload* with the options in
+        *header*. Return the reply header, with the status (`ok`,
+        `error`, or `timeout`) and the log, and the archive of the
+        tables written by parsing.
+        """
+        image = self.image_path(header['image'])
+        with cache.file_lock(image + '.lock'):
+            if not isfile(image):
+                return ({'status': 'error', 'log': 'Grammar image not found'},
+                        b'')
+            held = cache.hold(image)
+        tmp = tempfile.mkdtemp(dir=self.work_dir)
+        try:
+            prof = pjoin(tmp, 'profile')
+            os.mkdir(prof)
+            unpack_profile(payload, prof)
+            logf = pjoin(tmp, 'run.log')
+            status = 'ok'
+            with open(logf, 'w') as log, time_limit(header.get('timeout')):
+                try:
+                    run_art(
+                        image,
+                        prof,
+                        options=header.get('art_opts'),
+                        ace_preprocessor=header.get('preprocessor'),
+                        ace_options=header.get('ace_opts'),
+                        log=log
+                    )
+                except ProfileTimeout:
+                    status = 'timeout'
+                except (CalledProcessError, OSError):
+                    status = 'error'
+            data = b''
+            if status == 'ok':
+                data = pack_profile(prof, tables=PARSE_TABLES)
+            with open(logf) as log:
+                return {'status': status, 'log': log.read()}, data
+        finally:
+            shutil.rmtree(tmp)
+            held.close()
+
+
+class WorkerServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """
+    A TCP server handling each client connection in a thread, with the
+    jobs done by *worker*.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, worker):
+        socketserver.TCPServer.__init__(self, address, _WorkerHandler)
+        self.worker = worker
+
+
+class _WorkerHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        worker = self.server.worker
+        sock = self.request
+        client = '{}:{}'.format(*self.client_address[:2])
+        debug('Client connected: {}'.format(client))
+        try:
+            while True:
+                header = recv_header(sock)
+                op = header.get('op')
+                if op == 'image':
+                    reply, data = worker.store_image(sock, header), b''
+                else:
+                    payload = recv_payload(sock, header)
+                    if op == 'has-image':
+                        reply, data = worker.has_image(header), b''
+                    elif op == 'parse':
+                        info('Parsing profile for {}'.format(client))
+                        reply, data = worker.parse(header, payload)
+                    else:
+                        raise ValueError('Unknown operation: {}'.format(op))
+                send_message(sock, reply, data)
+        except (socket.error, IOError, OSError, ValueError, KeyError,
+                tarfile.TarError) as ex:
+            debug('Client disconnected: {} ({})'.format(client, ex))
+
+
+#
+# CLIENT
+#
+
+class WorkerPool(object):
+    """
+    Connections to the gTest workers at *addresses* (a list of (host,
+    port) pairs) for parsing profiles with the grammar image *grm*. Up
+    to *size* connections are opened on demand, spread over the workers
+    in turn. A worker whose connection fails is not used again.
+    """
+
+    def __init__(self, addresses, grm, size=1):
+        self.addresses = list(addresses)
+        self.grm = grm
+        self.size = size
+        # images are named by hash on workers, so only contents matter
+        self.image = cache.hash_files([grm], basedir=dirname(grm))
+        self._idle = Queue()
+        self._count = 0
+        self._next = 0
+        self._dead = set()
+        self._has_image = set()
+        self._image_locks = dict((a, threading.Lock()) for a in addresses)
+        self._socks = set()  # all open connections, idle or not
+        self._lock = threading.Lock()
+
+    def parse_profile(self, prof_path, args, log=None):
+        """
+        Parse the (freshly created) profile at *prof_path* on a worker
+        with the art and ACE options in *args*, and write the tables it
+        returns into the profile.
+        """
+        debug('Parsing profile with a worker: {}'.format(abspath(prof_path)),
+              log)
+        limit = current_deadline()
+        check_deadline(limit)
+        header = {
+            'op': 'parse',
+            'image': self.image,
+            'art_opts': args.art_opts,
+            'ace_opts': args.ace_opts,
+            'preprocessor': args.preprocessor,
+            'timeout': None if limit is None else limit.at - time.time()
+        }
+        payload = pack_profile(prof_path)
+        while True:
+            address, sock = self._acquire()
+            try:
+                self._send_image(address, sock)
+                send_message(sock, header, payload)
+                reply, data = recv_message(sock)
+            except (socket.error, IOError, OSError, ValueError) as ex:
+                warning('Worker {}:{} failed ({}); not using it again.'
+                        .format(address[0], address[1], ex), log)
+                self._discard(address, sock, dead=True)
+                continue
+            self._idle.put((address, sock))
+            break
+        if log is not None:
+            log.write(reply.get('log', ''))
+            log.flush()
+        if reply['status'] == 'timeout':
+            check_deadline(limit, expired=True)
+        if reply['status'] != 'ok':
+            error('Worker {}:{} failed to parse {}'
+                  .format(address[0], address[1], prof_path), log)
+            raise CalledProcessError(1, 'art (on {}:{})'.format(*address))
+        unpack_profile(data, prof_path)
+        debug('Completed parsing. Output at {}'.format(prof_path), log)
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except Empty:
+            pass
+        while True:
+            with self._lock:
+                live = [a for a in self.addresses if a not in self._dead]
+                if not live:
+                    raise CalledProcessError(-1, 'gTest worker')
+                spawn = self._count < self.size
+                if spawn:
+                    self._count += 1
+                    address = live[self._next % len(live)]
+                    self._next += 1
+            if not spawn:
+                # wait for a connection, checking that workers remain
+                try:
+                    return self._idle.get(timeout=1)
+                except Empty:
+                    continue
+            debug('Connecting to worker {}:{}'.format(*address))
+            try:
+                sock = socket.create_connection(address)
+            except (socket.error, IOError, OSError) as ex:
+                warning('Could not connect to worker {}:{} ({}); not using '
+                        'it.'.format(address[0], address[1], ex))
+                self._discard(address, None, dead=True)
+                continue
+            with self._lock:
+                self._socks.add(sock)
+            return address, sock
+
+    def _send_image(self, address, sock):
+        # the lock keeps concurrent connections from sending it twice
+        with self._image_locks[address]:
+            if address in self._has_image:
+                return
+            send_message(sock, {'op': 'has-image', 'image': self.image})
+            reply = recv_message(sock)[0]
+            if not reply['have']:
+                info('Sending grammar image to worker {}:{}'
+                     .format(*address))
+                send_file_message(sock, {'op': 'image', 'image': self.image},
+                                  self.grm)
+                recv_message(sock)
+            self._has_image.add(address)
+
+    def _discard(self, address, sock, dead=False):
+        with self._lock:
+            self._count -= 1
+            if dead:
+                self._dead.add(address)
+            if sock is not None:
+                self._socks.discard(sock)
+        if sock is not None:
+            sock.close()
+
+    def close(self):
+        """
+        Close all idle connections.
+        """
+        while True:
+            try:
+                address, sock = self._idle.get_nowait()
+            except Empty:
+                break
+            self._discard(address, sock)
+
+    def terminate(self):
+        """
+        Shut down all connections, including those in use; the profiles
+        being parsed with them fail.
+        """
+        with self._lock:
+            socks = list(self._socks)
+            self._dead.update(self.addresses)
+        for sock in socks:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except (socket.error, OSError):
+                pass